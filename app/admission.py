@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+import ipaddress
+import logging
+import math
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+# Admission control in front of the API, checked before a request reaches
+# its route, cheapest first:
+#
+#   body size   a Content-Length over max_body_size is refused with 413 before
+#               the body is read, and a body without one is counted as it
+#               streams in and cut off at the same size
+#   rate        each client address (see client_host) has a token bucket in
+#               redis, refilled at rate requests per second up to burst, so
+#               the limit holds across workers; an empty bucket is refused with 429 and a
+#               Retry-After of when the next token is due
+#   uploads     a worker serves at most max_uploads file uploads at a time and
+#               refuses more with 429, as each holds a staging key in redis
+#               and a worker thread while it streams in
+#
+# A rate of 0 disables the buckets.  Redis errors admit the request, the
+# limiter is not worth an outage.
+
+# KEYS: bucket  ARGV: rate per second, burst
+# Takes a token from the bucket.  Returns 0 when admitted, otherwise the
+# milliseconds until the next token.
+take_token_lua = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local rate = tonumber(ARGV[1]) / 1000
+local burst = tonumber(ARGV[2])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(bucket[1] or burst)
+local at = tonumber(bucket[2] or now)
+tokens = math.min(burst, tokens + math.max(now - at, 0) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = math.ceil((1 - tokens) / rate)
+else
+    tokens = tokens - 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'at', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate))
+return wait
+"""
+
+def trusted_networks(spec):
+    # Comma separated addresses or networks, e.g. "10.0.0.0/8, 127.0.0.1".
+    return [ipaddress.ip_network(item.strip(), strict=False) for item in spec.split(',') if item.strip()]
+
+def is_trusted(host, networks):
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in networks)
+
+def client_host(headers, host, proxies):
+    # The client address: the peer, or when the peer is a trusted proxy the
+    # last X-Forwarded-For hop not added by one of them.  Hops before it are
+    # whatever the client sent and would let it pick its own bucket.
+    if not is_trusted(host, proxies):
+        return host
+    hops = []
+    for name, value in headers:
+        if name == b'x-forwarded-for':
+            hops.extend(hop.strip() for hop in value.decode('latin-1').split(','))
+    for hop in reversed(hops):
+        if not hop:
+            break
+        host = hop
+        if not is_trusted(hop, proxies):
+            break
+    return host
+
+def rejection(status, detail, retry_after=None):
+    headers = {'Retry-After': str(max(1, math.ceil(retry_after)))} if retry_after is not None else None
+    return JSONResponse({'detail': detail}, status_code=status, headers=headers)
+
+class Admission:
+
+    def __init__(self, redis, rate, burst, max_uploads, max_body_size, upload_paths, proxies=()):
+        self.redis = redis
+        self.rate = rate
+        self.burst = burst
+        self.max_uploads = max_uploads
+        self.max_body_size = max_body_size
+        self.upload_paths = upload_paths
+        self.proxies = proxies
+        self.take_token_script = redis.register_script(take_token_lua)
+        self.uploads = 0
+        self.counts = {'rate': 0, 'uploads': 0, 'size': 0}
+
+    async def take_token(self, client):
+        # Returns the seconds until client may send again, 0 if it may now.
+        if self.rate <= 0:
+            return 0
+        try:
+            wait = await self.take_token_script(keys=[f'rclip+rate:{client}'], args=[self.rate, self.burst],
+                                                client=self.redis)
+        except Exception as e:
+            logging.warning(f'rate limit not checked: {type(e).__name__} {e}')
+            return 0
+        return wait / 1000
+
+    def stats(self):
+        return {'uploads': self.uploads,
+                'rejected': dict(self.counts)}
+
+class AdmissionMiddleware:
+    # Plain ASGI middleware, like MetricsMiddleware, so that a body is counted
+    # as it streams in rather than after it was buffered.
+
+    def __init__(self, app, admission):
+        self.app = app
+        self.admission = admission
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith('/api/'):
+            return await self.app(scope, receive, send)
+        admission = self.admission
+
+        length = None
+        for name, value in scope['headers']:
+            if name == b'content-length' and value.isdigit():
+                length = int(value)
+        if length is not None and length > admission.max_body_size:
+            admission.counts['size'] += 1
+            response = rejection(413, f'Request body exceeds {admission.max_body_size} bytes')
+            return await response(scope, receive, send)
+
+        peer = scope['client'][0] if scope['client'] else ''
+        wait = await admission.take_token(client_host(scope['headers'], peer, admission.proxies))
+        if wait > 0:
+            admission.counts['rate'] += 1
+            response = rejection(429, 'Too many requests', wait)
+            return await response(scope, receive, send)
+
+        upload = scope['method'] == 'POST' and scope['path'] in admission.upload_paths
+        if upload and admission.uploads >= admission.max_uploads:
+            admission.counts['uploads'] += 1
+            response = rejection(429, 'Too many uploads in progress', 1)
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > admission.max_body_size:
+                    admission.counts['size'] += 1
+                    raise HTTPException(status_code=413, detail=f'Request body exceeds {admission.max_body_size} bytes')
+            return message
+
+        if upload:
+            admission.uploads += 1
+        try:
+            await self.app(scope, limited_receive, send)
+        finally:
+            if upload:
+                admission.uploads -= 1
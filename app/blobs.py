@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import asyncio
+import mmap
+import os
+import time
+
+# Payloads too large to keep in redis RAM live in a blob store while their
+# redis entry keeps the metadata and a 'blob' field naming the payload in
+# place of 'data'.  A store provides:
+#
+#   create()              a writer for a new blob, with write(data), size,
+#                         blob_id and discard()
+#   attach(writer, key)   make the written blob the payload of key; called
+#                         again for every key tried until one is claimed
+#   read(key, blob_id)    the payload as a bytes-like object, None if gone
+#   path(key, blob_id)    a local file of the payload for sendfile, or None
+#   remove(key, blob_id)
+#   sweep(live, grace, abandoned)
+#                         remove the blobs live([(key, blob_id), ...]) says
+#                         are no longer referenced, sparing those attached in
+#                         the last grace seconds, and writers idle for longer
+#                         than abandoned seconds
+#
+# Blobs are never deleted along with their entry: the sweep drops whatever
+# redis no longer points at, so they follow the expiry, deletion and flush of
+# their metadata without mirroring any TTL.
+
+class FileBlobWriter:
+
+    def __init__(self, directory):
+        self.blob_id = os.urandom(16).hex()
+        self.path = os.path.join(directory, self.blob_id)
+        self.file = open(self.path, 'xb')
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def discard(self):
+        self.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+class FileBlobStore:
+    # One file per blob, named key.blob_id under root, written under
+    # root/tmp first.  Reads are memory mapped.
+
+    def __init__(self, root):
+        self.root = root
+        self.tmp = os.path.join(root, 'tmp')
+        os.makedirs(self.tmp, exist_ok=True)
+
+    def create(self):
+        return FileBlobWriter(self.tmp)
+
+    def attach(self, writer, key):
+        writer.close()
+        path = self.file_name(key, writer.blob_id)
+        os.rename(writer.path, path)
+        writer.path = path
+
+    def file_name(self, key, blob_id):
+        if isinstance(key, bytes):
+            key = key.decode()
+        if isinstance(blob_id, bytes):
+            blob_id = blob_id.decode()
+        return os.path.join(self.root, f'{key}.{blob_id}')
+
+    def path(self, key, blob_id):
+        path = self.file_name(key, blob_id)
+        return path if os.path.exists(path) else None
+
+    def read(self, key, blob_id):
+        try:
+            with open(self.file_name(key, blob_id), 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return b''
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+
+    def remove(self, key, blob_id):
+        try:
+            os.unlink(self.file_name(key, blob_id))
+        except FileNotFoundError:
+            pass
+
+    async def sweep(self, live, grace, abandoned, batch=1000):
+        now = time.time()
+        blobs = await asyncio.to_thread(self.list)
+        removed = 0
+        for first in range(0, len(blobs), batch):
+            candidates = [(key, blob_id) for key, blob_id, ctime in blobs[first:first + batch]
+                          if now - ctime > grace]
+            if not candidates:
+                continue
+            for (key, blob_id), alive in zip(candidates, await live(candidates)):
+                if not alive:
+                    await asyncio.to_thread(self.remove, key, blob_id)
+                    removed += 1
+        await asyncio.to_thread(self.remove_abandoned, abandoned)
+        return removed
+
+    def list(self):
+        # Returns (key, blob_id, ctime) of every attached blob.
+        blobs = []
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                key, dot, blob_id = entry.name.rpartition('.')
+                if dot and entry.is_file():
+                    try:
+                        blobs.append((key, blob_id, entry.stat().st_ctime))
+                    except FileNotFoundError:
+                        pass
+        return blobs
+
+    def remove_abandoned(self, age):
+        # Writers left behind by a crashed worker.
+        now = time.time()
+        with os.scandir(self.tmp) as entries:
+            for entry in entries:
+                try:
+                    if now - entry.stat().st_mtime > age:
+                        os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import asyncio
+import time
+from collections import OrderedDict
+
+class HotCache:
+    # Per-worker LRU of recently read entries, bounded by the bytes of their
+    # values.  An entry lives no longer than max_age nor than the redis TTL
+    # its loader reports, and concurrent misses on one key share a single
+    # load.  Keys invalidated while they load are not stored, so a read that
+    # raced a delete is never cached.
+
+    def __init__(self, max_bytes, max_age, max_item_bytes=None, on_lookup=None):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_item_bytes = max_item_bytes if max_item_bytes is not None else max_bytes // 8
+        self.on_lookup = on_lookup
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.stale = set()
+        self.bytes = 0
+        self.counts = {'hit': 0, 'miss': 0, 'coalesced': 0}
+
+    def count(self, result):
+        self.counts[result] += 1
+        if self.on_lookup is not None:
+            self.on_lookup(result)
+
+    async def get(self, key, load):
+        # load() returns (value, ttl); a ttl of None keeps the value out of
+        # the cache, e.g. for a missing entry.
+        while True:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, _, value = entry
+                if expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.count('hit')
+                    return value
+                self.drop(key)
+            future = self.loading.get(key)
+            if future is None:
+                break
+            self.count('coalesced')
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # The load was abandoned by its own caller; try again unless
+                # this caller is the one being cancelled.
+                if not future.cancelled():
+                    raise
+
+        self.count('miss')
+        future = asyncio.get_running_loop().create_future()
+        self.loading[key] = future
+        try:
+            value, ttl = await load()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            del self.loading[key]
+            stale = key in self.stale
+            self.stale.discard(key)
+        future.set_result(value)
+        if ttl is not None and not stale:
+            self.put(key, value, ttl)
+        return value
+
+    def put(self, key, value, ttl):
+        values = value.values() if isinstance(value, dict) else value
+        size = sum(len(v) for v in values if isinstance(v, (bytes, bytearray)))
+        if size > self.max_item_bytes:
+            return
+        self.drop(key)
+        self.entries[key] = (time.monotonic() + min(ttl, self.max_age), size, value)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, evicted, _) = self.entries.popitem(last=False)
+            self.bytes -= evicted
+
+    def drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def invalidate(self, keys):
+        for key in keys:
+            self.drop(key)
+            if key in self.loading:
+                self.stale.add(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+        self.stale.update(self.loading)
+
+    def stats(self):
+        return {'entries': len(self.entries),
+                'bytes': self.bytes,
+                'hits': self.counts['hit'],
+                'misses': self.counts['miss'],
+                'coalesced': self.counts['coalesced']}
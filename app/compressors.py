@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import gzip
+import io
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def available_encodings():
+    if zstandard is not None:
+        return ['zstd', 'gzip']
+    return ['gzip']
+
+def parse_accept_encoding(header):
+    if header is None:
+        return []
+    return [token.split(';')[0].strip().lower() for token in header.split(',') if token.strip()]
+
+def compress(data, encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    elif encoding == 'gzip':
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    raise ValueError(f'Unsupported encoding {encoding}')
+
+def decompressor(encoding):
+    # Both objects take compressed pieces through decompress() and return
+    # whatever output is ready, so large values can be decoded in slices.
+    if encoding == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+    elif encoding == 'gzip':
+        return zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    raise ValueError(f'Unsupported encoding {encoding}')
+
+def decompress(data, encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    elif encoding == 'gzip':
+        return gzip.decompress(data)
+    raise ValueError(f'Unsupported encoding {encoding}')
+
+def iter_decompressed(data, encoding, size):
+    # Yields data decoded in pieces of at most size bytes, so that a caller
+    # can stop a small stream that inflates to gigabytes early.  Raises
+    # ValueError unless data is one whole stream of encoding.
+    if encoding == 'zstd':
+        reader = zstandard.ZstdDecompressor().stream_reader(data)
+        errors = zstandard.ZstdError
+    elif encoding == 'gzip':
+        reader = gzip.GzipFile(fileobj=io.BytesIO(data))
+        errors = (OSError, EOFError, zlib.error)
+    else:
+        raise ValueError(f'Unsupported encoding {encoding}')
+    try:
+        while True:
+            piece = reader.read(size)
+            if not piece:
+                break
+            yield piece
+    except errors as e:
+        raise ValueError(str(e))
+    # The zstd reader ends quietly where a frame is cut short.
+    if encoding == 'zstd':
+        decoder = zstandard.ZstdDecompressor().decompressobj()
+        decoder.decompress(data)
+        if not decoder.eof:
+            raise ValueError('Truncated zstd data')
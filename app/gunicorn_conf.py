@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+
+# Picked up by the base image in place of its own /gunicorn_conf.py, whose
+# settings are kept.  Adds the hooks prometheus_client needs when workers
+# share metrics through PROMETHEUS_MULTIPROC_DIR.
+
+import os
+import shutil
+
+base_conf = '/gunicorn_conf.py'
+if os.path.exists(base_conf):
+    with open(base_conf) as f:
+        exec(compile(f.read(), base_conf, 'exec'))
+
+def on_starting(server):
+    # Samples left by a previous run would be merged into the new one.
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
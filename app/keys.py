@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import hashlib
+import time
+from fastapi import HTTPException
+
+stats_key = 'rclip+stats'
+
+class KeyAllocator:
+    # Hands out short hex keys that are claimed atomically by the caller
+    # (set-if-absent), retrying with a new candidate on collision.  The key
+    # width grows with the number of live keys so that a fresh candidate
+    # collides with probability at most max_occupancy, and grows once more
+    # for the remaining attempts of an allocation that keeps colliding.
+
+    def __init__(self, redis, min_width, max_occupancy, refresh_interval, max_attempts=8):
+        self.redis = redis
+        self.min_width = min_width
+        self.max_occupancy = max_occupancy
+        self.refresh_interval = refresh_interval
+        self.max_attempts = max_attempts
+        self.entries = 0
+        self.refreshed = 0
+
+    async def width(self):
+        if time.monotonic() - self.refreshed > self.refresh_interval:
+            self.entries = await self.redis.dbsize()
+            self.refreshed = time.monotonic()
+        width = self.min_width
+        while self.entries > (256 ** width) * self.max_occupancy:
+            width += 1
+        return width
+
+    async def allocate(self, key_src, claim):
+        width = await self.width()
+        for attempt in range(self.max_attempts):
+            seed = key_src if attempt == 0 else f'{key_src}:{attempt}'
+            key = hashlib.blake2s(seed.encode(), digest_size=width).hexdigest()
+            if await claim(key):
+                return key
+            await self.redis.hincrby(stats_key, 'collisions', 1)
+            if attempt % 2 == 1:
+                width += 1
+        raise HTTPException(status_code=503, detail='No free key')
+
+    async def allocate_many(self, key_srcs, claim_many):
+        # Like allocate for a batch: each attempt claims the candidates of all
+        # entries still without a key in one call, claim_many(indexes, keys)
+        # returning whether each was claimed, so a batch costs a round trip
+        # per attempt rather than per entry.
+        width = await self.width()
+        keys = [None] * len(key_srcs)
+        pending = list(range(len(key_srcs)))
+        for attempt in range(self.max_attempts):
+            candidates = []
+            for i in pending:
+                seed = key_srcs[i] if attempt == 0 else f'{key_srcs[i]}:{attempt}'
+                candidates.append(hashlib.blake2s(seed.encode(), digest_size=width).hexdigest())
+            collided = []
+            for i, key, claimed in zip(pending, candidates, await claim_many(pending, candidates)):
+                if claimed:
+                    keys[i] = key
+                else:
+                    collided.append(i)
+            if not collided:
+                return keys
+            await self.redis.hincrby(stats_key, 'collisions', len(collided))
+            pending = collided
+            if attempt % 2 == 1:
+                width += 1
+        raise HTTPException(status_code=503, detail='No free key')
+
+    async def stats(self):
+        self.refreshed = 0
+        width = await self.width()
+        collisions = await self.redis.hget(stats_key, 'collisions')
+        capacity = 256 ** width
+        return {'entries': self.entries,
+                'key_width': width,
+                'capacity': capacity,
+                'occupancy': self.entries / capacity,
+                'collisions': int(collisions or 0)}
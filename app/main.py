@@ -1,25 +1,224 @@
 #!/usr/bin/env python3
 
+import asyncio
+import base64
+import binascii
+import codecs
 import hashlib
+import logging
 import os
 import re
 import time
-from redis import Redis
+import urllib.parse
+from redis.asyncio import Redis
 from typing import Optional
-from fastapi import FastAPI, Request, Response, File, UploadFile, Header, HTTPException
+from fastapi import FastAPI, Request, Response, Header, HTTPException
+from fastapi.responses import FileResponse, StreamingResponse
 
-from models import MessageModel, TTLModel
+from admission import Admission, AdmissionMiddleware, trusted_networks
+from models import BatchKeysModel, BatchMessagesModel, BatchTTLModel, ChunksModel, ManifestModel, MessageModel, TTLModel
+from blobs import FileBlobStore
+from cache import HotCache
+from compressors import available_encodings, compress, decompress, decompressor, iter_decompressed, parse_accept_encoding
+from keys import KeyAllocator
+import metrics as prometheus_metrics
+from namespaces import Namespace
+from storage import Storage, connect, hash_tag
+from uploads import iter_file_upload
+from watchers import KeyWatcher
 
 redis_host = os.environ.get("REDIS_HOST", "localhost")
 redis_port = os.environ.get("REDIS_PORT", "6379")
+redis_cluster = os.environ.get("REDIS_CLUSTER", "off")
 redis_ttl = os.environ.get("REDIS_TTL", "60")
 key_width = os.environ.get("KEY_WIDTH", "4")
+redis_pool_size = os.environ.get("REDIS_POOL_SIZE", "50")
+redis_pool_timeout = os.environ.get("REDIS_POOL_TIMEOUT", "20")
+redis_socket_timeout = os.environ.get("REDIS_SOCKET_TIMEOUT", "10")
+redis_connect_timeout = os.environ.get("REDIS_CONNECT_TIMEOUT", "5")
+redis_health_check_interval = os.environ.get("REDIS_HEALTH_CHECK_INTERVAL", "30")
+max_fragment_size = os.environ.get("MAX_FRAGMENT_SIZE", "16000000")
+upload_piece_size = os.environ.get("UPLOAD_PIECE_SIZE", "262144")
+upload_timeout = os.environ.get("UPLOAD_TIMEOUT", "600")
+download_piece_size = os.environ.get("DOWNLOAD_PIECE_SIZE", "262144")
+compression = os.environ.get("COMPRESSION", "zstd")
+compress_min_size = os.environ.get("COMPRESS_MIN_SIZE", "1024")
+key_max_occupancy = os.environ.get("KEY_MAX_OCCUPANCY", "0.05")
+key_width_refresh = os.environ.get("KEY_WIDTH_REFRESH", "10")
+max_batch_size = os.environ.get("MAX_BATCH_SIZE", "1000")
+blob_dir = os.environ.get("BLOB_DIR", "")
+blob_threshold = os.environ.get("BLOB_THRESHOLD", "262144")
+blob_sweep_interval = os.environ.get("BLOB_SWEEP_INTERVAL", "60")
+blob_sweep_grace = os.environ.get("BLOB_SWEEP_GRACE", "60")
+cache_size = os.environ.get("CACHE_SIZE", "67108864")
+cache_max_age = os.environ.get("CACHE_MAX_AGE", "30")
+metrics_enabled = os.environ.get("METRICS", "off")
+wait_max = os.environ.get("WAIT_MAX", "60")
+wait_poll_interval = os.environ.get("WAIT_POLL_INTERVAL", "5")
+keyspace_events = os.environ.get("KEYSPACE_EVENTS", "Kghxe")
+flush_batch_size = os.environ.get("FLUSH_BATCH_SIZE", "500")
+rate_limit = os.environ.get("RATE_LIMIT", "0")
+rate_burst = os.environ.get("RATE_BURST", "1000")
+max_uploads = os.environ.get("MAX_UPLOADS", "16")
+max_body_size = os.environ.get("MAX_BODY_SIZE", "33554432")
+trusted_proxies = os.environ.get("TRUSTED_PROXIES", "")
 
-redis = Redis(host=redis_host, port=redis_port)
+# Encoding used for plain messages stored by clients that do not compress
+# themselves; zstd falls back to gzip when zstandard is not installed.
+if compression == 'none':
+    storage_encoding = None
+elif compression in available_encodings():
+    storage_encoding = compression
+else:
+    storage_encoding = 'gzip'
+
+# One bounded pool per worker process; a request waits up to
+# REDIS_POOL_TIMEOUT seconds for a free connection instead of opening more.
+#
+# With REDIS_CLUSTER=on, REDIS_HOST:REDIS_PORT is any node of a redis cluster
+# and keys are hash tagged so that each entry is served by one shard (see
+# storage.py), with up to REDIS_POOL_SIZE connections per node.  Pub/sub
+# messages reach every node of a cluster, so they go through a plain
+# connection to that node.
+cluster = redis_cluster == 'on'
+redis = connect(redis_host, int(redis_port), cluster, int(redis_pool_size), float(redis_pool_timeout),
+                float(redis_socket_timeout), float(redis_connect_timeout), int(redis_health_check_interval))
+if cluster:
+    pubsub_redis = Redis(host=redis_host, port=int(redis_port),
+                         socket_connect_timeout=float(redis_connect_timeout),
+                         health_check_interval=int(redis_health_check_interval))
+else:
+    pubsub_redis = redis
+storage = Storage(redis, cluster, int(upload_timeout))
+allocator = KeyAllocator(redis, int(key_width), float(key_max_occupancy), float(key_width_refresh))
+
+# With BLOB_DIR set, file fragments over BLOB_THRESHOLD bytes are kept on disk
+# there and only their metadata in redis.
+blobs = FileBlobStore(blob_dir) if blob_dir else None
 
 app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None,
               title="rclip", description="Remote clipboard")
 
+# Requests over RATE_LIMIT per second per client, file uploads beyond
+# MAX_UPLOADS per worker and bodies over MAX_BODY_SIZE are refused before
+# they reach a route (see admission.py).  The rate limit costs every request
+# a redis round trip, fragment transfers included, and is off by default.  X-Forwarded-For only names the
+# client of a request coming from one of TRUSTED_PROXIES.
+admission = Admission(redis, float(rate_limit), int(rate_burst), int(max_uploads), int(max_body_size),
+                      {'/api/v1/files'}, trusted_networks(trusted_proxies))
+app.add_middleware(AdmissionMiddleware, admission=admission)
+
+# With METRICS=on and prometheus_client installed, requests and redis round
+# trips are measured and exposed at /metrics; otherwise metrics is None.
+if metrics_enabled == 'on' and prometheus_metrics.available():
+    metrics = prometheus_metrics.Metrics()
+    metrics.instrument(redis)
+    app.add_middleware(prometheus_metrics.MetricsMiddleware, metrics=metrics)
+
+    @app.get('/metrics')
+    async def get_metrics():
+        return Response(content=metrics.generate(await redis.dbsize()),
+                        media_type=metrics.content_type)
+else:
+    metrics = None
+
+async def sweep_blobs():
+    # Every worker sweeps; removing a blob twice is harmless.
+    while True:
+        await asyncio.sleep(float(blob_sweep_interval))
+        try:
+            await blobs.sweep(storage.blobs_live, float(blob_sweep_grace), float(upload_timeout))
+        except Exception:
+            logging.exception('blob sweep failed')
+
+@app.on_event('startup')
+async def start_blob_sweep():
+    if blobs is not None:
+        app.state.blob_sweep = asyncio.create_task(sweep_blobs())
+
+# Each worker keeps recently read entries in a hot-key cache of CACHE_SIZE
+# bytes (0 disables it).  Deletes, TTL changes and flushes are published on
+# invalidation_channel so that every worker drops its copy, and a worker
+# that loses its subscription empties its cache when it subscribes again.
+invalidation_channel = 'rclip+invalidate'
+cached_fields = ('data', 'blob', 'category', 'key_src', 'encoding', 'raw_size', 'size')
+
+def count_cache_lookup(result):
+    if metrics is not None:
+        metrics.cache_lookups.labels(result).inc()
+
+cache = HotCache(int(cache_size), float(cache_max_age), on_lookup=count_cache_lookup) if int(cache_size) > 0 else None
+
+async def read_entry(key):
+    # Returns a dict of cached_fields of key, all None when it is missing.
+    if cache is None:
+        return dict(zip(cached_fields, await storage.read(key, *cached_fields)))
+    async def load():
+        values, pttl = await storage.read_ttl(key, *cached_fields)
+        if pttl == -2:
+            return dict(zip(cached_fields, values)), None
+        return dict(zip(cached_fields, values)), pttl / 1000 if pttl > 0 else float(cache_max_age)
+    return await cache.get(key, load)
+
+async def invalidate(keys):
+    if cache is not None and keys:
+        cache.invalidate(keys)
+        await redis.publish(invalidation_channel, ' '.join(keys))
+
+async def listen_invalidations():
+    while True:
+        try:
+            async with pubsub_redis.pubsub() as pubsub:
+                await pubsub.subscribe(invalidation_channel)
+                cache.clear()
+                async for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    keys = message['data'].decode().split()
+                    if '*' in keys:
+                        cache.clear()
+                    else:
+                        cache.invalidate(keys)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception('cache invalidation listener failed')
+            await asyncio.sleep(1)
+
+@app.on_event('startup')
+async def start_invalidation_listener():
+    if cache is not None:
+        app.state.invalidation_listener = asyncio.create_task(listen_invalidations())
+
+# Requests waiting for a key to appear or change are woken by redis keyspace
+# notifications, which each worker adds KEYSPACE_EVENTS to at startup (empty
+# to leave notify-keyspace-events to the redis configuration).  If redis does
+# not allow it, waiters look again every WAIT_POLL_INTERVAL seconds instead.
+# So do they on a cluster, whose nodes only notify their own keys.
+watch_channel = 'rclip+watch'
+watcher = KeyWatcher(pubsub_redis, watch_channel)
+
+@app.on_event('startup')
+async def start_watcher():
+    if cluster or keyspace_events and not await watcher.configure(keyspace_events):
+        watcher.poll_interval = float(wait_poll_interval)
+    app.state.watcher = asyncio.create_task(watcher.run())
+
+@app.on_event('shutdown')
+async def close_redis():
+    if blobs is not None:
+        app.state.blob_sweep.cancel()
+    if cache is not None:
+        app.state.invalidation_listener.cancel()
+    app.state.watcher.cancel()
+    await redis.aclose()
+    for task in flush_tasks:
+        task.cancel()
+    if cluster:
+        await pubsub_redis.aclose()
+    else:
+        await redis.connection_pool.disconnect()
+
 @app.get('/api/v1/clipboard')
 async def ping(request: Request):
     ip = request.client.host
@@ -37,97 +236,743 @@ async def ping(request: Request):
             }
     }
 
+@app.get('/api/v1/clipboard/stats')
+async def get_stats(x_rclip_namespace: Optional[str] = Header(None)):
+    namespace = Namespace(x_rclip_namespace, cluster)
+    stats = await allocator.stats()
+    keys, size = await storage.namespace_stats(namespace.name)
+    stats['namespace'] = {'name': namespace.name, 'keys': keys, 'bytes': size}
+    if cache is not None:
+        stats['cache'] = cache.stats()
+    stats['watch'] = watcher.stats()
+    stats['admission'] = admission.stats()
+    return {'request': '(stats)',
+            'response': stats}
+
+# A flush deletes the entries of one namespace only, FLUSH_BATCH_SIZE at a
+# time in the background, so that redis keeps serving everyone else.  Flushes
+# cut short by a restart are resumed by the workers as they start.
+flush_tasks = set()
+
+async def flush_namespace(namespace, flush_id):
+    try:
+        while True:
+            left, keys = await storage.flush_batch(namespace, flush_id, int(flush_batch_size))
+            await invalidate(keys)
+            # Waiters polling, on a cluster or without keyspace
+            # notifications, learn of the deletes at once.
+            if keys:
+                await watcher.publish(keys)
+            if left == 0:
+                break
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logging.exception(f'flush of namespace {namespace!r} failed')
+
+def start_flush(namespace, flush_id):
+    task = asyncio.create_task(flush_namespace(namespace, flush_id))
+    flush_tasks.add(task)
+    task.add_done_callback(flush_tasks.discard)
+
+@app.on_event('startup')
+async def resume_flushes():
+    for namespace, flush_id in await storage.flushes():
+        start_flush(namespace, flush_id)
+
 @app.delete('/api/v1/clipboard')
-async def delete_clippboard(request: Request):
-    result = 'OK' if redis.flushdb() == True else 'NG'
+async def delete_clippboard(x_rclip_namespace: Optional[str] = Header(None)):
+    namespace = Namespace(x_rclip_namespace, cluster)
+    keys, size = await storage.namespace_stats(namespace.name)
+    flush_id = await storage.start_flush(namespace.name)
+    if flush_id is not None:
+        start_flush(namespace.name, flush_id)
     return {'request': '(flush)',
-            'response': {'result': result}}
+            'response': {'result': 'OK', 'namespace': namespace.name, 'keys': keys, 'bytes': size}}
 
-@app.post('/api/v1/messages')
-async def post_message(message_data: MessageModel, x_ttl: Optional[int] = Header(None)):
+# A manifest is stored like a message of category 'file-fragment-list' whose
+# payload is 'quoted-basename:key1:key2:...', so clients reading it through
+# /api/v1/messages keep working.
+category_file_fragment_list = 'file-fragment-list'
+
+def message_entry(message_data: MessageModel):
+    # Returns the key source and the stored fields of a posted message.  A
+    # client that compressed the message sends it base64 encoded with its
+    # encoding.
     message = message_data.message
-    if message_data.category is not None:
-        category = message_data.category
+    encoding = message_data.encoding
+    if encoding is not None:
+        check_encoding(encoding)
+        try:
+            payload = base64.b64decode(message, validate=True)
+        except binascii.Error:
+            raise HTTPException(status_code=422, detail='Invalid base64 message')
+        length, raw_size = decode_message(payload, encoding)
     else:
+        payload = message.encode()
+        length, raw_size = len(message), len(payload)
+    return entry_fields(message, payload, message_data.category, encoding, length, raw_size)
+
+def check_encoding(encoding):
+    if encoding not in available_encodings():
+        raise HTTPException(status_code=415, detail=f'Unsupported encoding {encoding}')
+
+def decode_message(payload, encoding):
+    # Returns the length in characters and the size in bytes of the text a
+    # message compressed by its client decodes to.  It is decoded in pieces
+    # and refused once over MAX_FRAGMENT_SIZE bytes, so that a small body
+    # inflating to gigabytes costs little, and refused when it is not whole
+    # UTF-8 text, which readers not accepting its encoding would fail on.
+    text = codecs.getincrementaldecoder('utf-8')()
+    length = raw_size = 0
+    try:
+        for piece in iter_decompressed(payload, encoding, int(download_piece_size)):
+            raw_size += len(piece)
+            if raw_size > int(max_fragment_size):
+                raise HTTPException(status_code=413, detail=f'Message exceeds {max_fragment_size} bytes')
+            length += len(text.decode(piece))
+        length += len(text.decode(b'', final=True))
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=422, detail='Message is not UTF-8 text')
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f'Invalid {encoding} message')
+    return length, raw_size
+
+def entry_fields(message, payload, category, encoding, length, raw_size):
+    # Returns the key source and the stored fields of payload, the message
+    # as sent, and message, the text its key is made from; length and
+    # raw_size are those of the text decoded.  A compressed payload is
+    # stored as is.  Plain messages large enough are compressed here before
+    # they are stored, except fragment lists which the server reads itself
+    # and which are refused compressed.
+    if category is None:
         category = '__message__'
+    if encoding is not None and category == category_file_fragment_list:
+        raise HTTPException(status_code=422, detail=f'A {category_file_fragment_list} message cannot be compressed')
+    if encoding is None:
+        if storage_encoding is not None and len(payload) >= int(compress_min_size) \
+                and category != category_file_fragment_list:
+            compressed = compress(payload, storage_encoding)
+            if len(compressed) < len(payload):
+                payload = compressed
+                encoding = storage_encoding
+    key_time = str(time.time())
+    key_src = message + ':' + key_time
+    key_src_shadow = '*:' + key_time
+    fields = {'data': payload, 'key_src': key_src_shadow, 'category': category, 'size': length}
+    if encoding is not None:
+        fields.update({'encoding': encoding, 'raw_size': raw_size})
+    return key_src, fields
+
+def message_response(key, message, category, encoding, accept_encoding):
+    response = {'key': key, 'category': category}
+    if encoding is not None:
+        encoding = encoding.decode()
+        if encoding in parse_accept_encoding(accept_encoding):
+            message = base64.b64encode(message)
+            response['encoding'] = encoding
+        else:
+            message = decompress(message, encoding)
+    response['message'] = message
+    return response
+
+@app.post('/api/v1/messages')
+async def post_message(message_data: MessageModel, x_ttl: Optional[int] = Header(None),
+                       x_rclip_namespace: Optional[str] = Header(None)):
+    namespace = Namespace(x_rclip_namespace, cluster)
     if x_ttl is not None:
         ttl = x_ttl
     else:
         ttl = redis_ttl
-    key_time = str(time.time())
-    key_src = message + ':' + key_time
-    key_src_shadow = '*:' + key_time
-    key = hashlib.blake2s(key_src.encode(), digest_size=int(key_width)).hexdigest()
-    redis.set(key, message)
-    redis.hset(key+'+hash', 'key_src', key_src_shadow)
-    redis.hset(key+'+hash', 'category', category)
-    redis.hset(key+'+hash', 'size', len(message))
-    redis.expire(key, ttl)
-    redis.expire(key+'+hash', ttl)
+    key_src, fields = message_entry(message_data)
+    key = await allocator.allocate(key_src, lambda key: storage.create(namespace.key(key), ttl, fields))
+    message = message_data.message
     return {'request': {'message': message},
             'response': {'key': key, 'message': message}}
 
+def message_etag(key, key_src):
+    return '"' + hashlib.blake2s(key_src or key.encode(), digest_size=8).hexdigest() + '"'
+
+def entry_changed(key, entry, if_none_match):
+    # An entry is news to a client that has none when it exists, and to one
+    # holding the version if_none_match when it is gone or another.
+    if if_none_match is None:
+        return entry['data'] is not None
+    if entry['data'] is None:
+        return True
+    return message_etag(key, entry['key_src']) != if_none_match.strip()
+
+async def wait_for_change(key, if_none_match, timeout):
+    # Returns the entry once entry_changed, or as last read after timeout
+    # seconds.  It is read from redis, not the cache, which may still hold
+    # what another worker has just deleted or replaced.
+    entry = None
+    async def wait():
+        nonlocal entry
+        async with watcher.watch(key) as event:
+            while True:
+                event.clear()
+                entry = dict(zip(cached_fields, await storage.read(key, *cached_fields)))
+                if entry_changed(key, entry, if_none_match):
+                    return
+                try:
+                    await asyncio.wait_for(event.wait(), watcher.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+    try:
+        await asyncio.wait_for(wait(), timeout)
+    except asyncio.TimeoutError:
+        if entry is None:
+            entry = dict(zip(cached_fields, await storage.read(key, *cached_fields)))
+    return entry
+
 @app.get('/api/v1/messages/{key}')
-async def get_message(key: str):
-    if redis.exists(key) == 0:
-        raise HTTPException(status_code=404)
-    message = redis.get(key)
-    category = redis.hget(key+'+hash', 'category')
+async def get_message(key: str, response: Response, wait: float = 0,
+                      x_rclip_accept_encoding: Optional[str] = Header(None),
+                      if_none_match: Optional[str] = Header(None),
+                      x_rclip_namespace: Optional[str] = Header(None)):
+    entry = await read_message(Namespace(x_rclip_namespace, cluster).key(key), wait, if_none_match)
+    etag = message_etag(key, entry['key_src'])
+    if if_none_match is not None and if_none_match.strip() == etag:
+        return Response(status_code=304, headers={'ETag': etag})
+    response.headers['ETag'] = etag
     return {'request': {'key': key},
-            'response': {'key': key, 'category': category, 'message': message}}
+            'response': message_response(key, entry['data'], entry['category'], entry['encoding'],
+                                         x_rclip_accept_encoding)}
+
+async def read_message(entry_key, wait, if_none_match):
+    # With wait, the request is held up to wait seconds (WAIT_MAX at most)
+    # until the entry exists or, with If-None-Match, is deleted or replaced.
+    # Unanswered, it ends as it would have without waiting.
+    if wait > 0:
+        entry = await wait_for_change(entry_key, if_none_match, min(wait, float(wait_max)))
+    else:
+        entry = await read_entry(entry_key)
+    if entry['data'] is None:
+        raise HTTPException(status_code=404)
+    return entry
+
+# The raw message API takes and returns the message itself as the body,
+# without the JSON envelope that sends it back along with its key and escapes
+# it both ways.  The category, TTL and encoding travel in headers, and the
+# category is percent-encoded as it may be any text.  A body is UTF-8 text,
+# or the text compressed with its X-Rclip-Encoding.  Errors are JSON as
+# elsewhere.
+
+raw_media_types = ('text/plain', 'application/octet-stream')
+
+@app.post('/api/v1/raw/messages')
+async def post_raw_message(request: Request, x_ttl: Optional[int] = Header(None),
+                           content_type: Optional[str] = Header(None),
+                           x_rclip_category: Optional[str] = Header(None),
+                           x_rclip_encoding: Optional[str] = Header(None),
+                           x_rclip_namespace: Optional[str] = Header(None)):
+    namespace = Namespace(x_rclip_namespace, cluster)
+    if x_ttl is not None:
+        ttl = x_ttl
+    else:
+        ttl = redis_ttl
+    if (content_type or '').partition(';')[0].strip().lower() not in raw_media_types:
+        raise HTTPException(status_code=415, detail=f'Unsupported content type {content_type}')
+    category = urllib.parse.unquote(x_rclip_category) if x_rclip_category is not None else None
+    payload = await request.body()
+    if x_rclip_encoding is not None:
+        check_encoding(x_rclip_encoding)
+        length, raw_size = decode_message(payload, x_rclip_encoding)
+        # Any text does as key source, as long as it differs with the payload.
+        message = payload.decode('latin-1')
+    else:
+        try:
+            message = payload.decode('utf-8')
+        except UnicodeDecodeError:
+            raise HTTPException(status_code=422, detail='Message is not UTF-8 text')
+        length, raw_size = len(message), len(payload)
+    key_src, fields = entry_fields(message, payload, category, x_rclip_encoding, length, raw_size)
+    key = await allocator.allocate(key_src, lambda key: storage.create(namespace.key(key), ttl, fields))
+    return Response(key, media_type='text/plain')
+
+@app.get('/api/v1/raw/messages/{key}')
+async def get_raw_message(key: str, wait: float = 0,
+                          x_rclip_accept_encoding: Optional[str] = Header(None),
+                          if_none_match: Optional[str] = Header(None),
+                          x_rclip_namespace: Optional[str] = Header(None)):
+    entry = await read_message(Namespace(x_rclip_namespace, cluster).key(key), wait, if_none_match)
+    etag = message_etag(key, entry['key_src'])
+    if if_none_match is not None and if_none_match.strip() == etag:
+        return Response(status_code=304, headers={'ETag': etag})
+    headers = {'ETag': etag, 'X-Rclip-Category': urllib.parse.quote(entry['category'].decode())}
+    data, encoding = entry['data'], entry['encoding']
+    if encoding is not None:
+        encoding = encoding.decode()
+        if encoding in parse_accept_encoding(x_rclip_accept_encoding):
+            headers['X-Rclip-Encoding'] = encoding
+            return Response(data, headers=headers, media_type='application/octet-stream')
+        data = decompress(data, encoding)
+    return Response(data, headers=headers, media_type='text/plain; charset=utf-8')
+
+def count_deleted(size):
+    if metrics is not None:
+        metrics.deleted_bytes.inc(size)
+
+# Deleting the message of a file manifest deletes the fragments it lists too,
+# in the same redis call, or the pipeline following it on a cluster.  Deletes report the keys and bytes they freed.
 
 @app.delete('/api/v1/messages/{key}')
-async def delete_message(key: str):
-    if redis.exists(key) == 0:
+async def delete_message(key: str, x_rclip_namespace: Optional[str] = Header(None)):
+    entry_key = Namespace(x_rclip_namespace, cluster).key(key)
+    result, size, deleted = await storage.delete(entry_key)
+    await invalidate(deleted or [entry_key])
+    if result == 0:
         raise HTTPException(status_code=404)
-    redis.delete(key)
-    redis.delete(key+'+hash')
+    count_deleted(size)
     return {'request': {'key': key},
-            'response': {'key': key}}
+            'response': {'key': key, 'deleted': len(deleted), 'bytes': size}}
+
+# Batches of messages are created, read, deleted or given a TTL in one
+# request and one redis pipeline.  Items keep the order of the request.
+
+def check_batch_size(size):
+    if size > int(max_batch_size):
+        raise HTTPException(status_code=413, detail=f'Batch exceeds {max_batch_size} items')
+
+@app.post('/api/v1/batch/messages')
+async def post_messages(batch_data: BatchMessagesModel, x_ttl: Optional[int] = Header(None),
+                        x_rclip_namespace: Optional[str] = Header(None)):
+    namespace = Namespace(x_rclip_namespace, cluster)
+    check_batch_size(len(batch_data.messages))
+    if x_ttl is not None:
+        ttl = x_ttl
+    else:
+        ttl = redis_ttl
+    key_srcs = []
+    entries = []
+    for message_data in batch_data.messages:
+        key_src, fields = message_entry(message_data)
+        key_srcs.append(key_src)
+        entries.append(fields)
+    async def claim_many(indexes, keys):
+        return await storage.create_many([(namespace.key(key), entries[i]) for i, key in zip(indexes, keys)], ttl)
+    keys = await allocator.allocate_many(key_srcs, claim_many) if entries else []
+    return {'request': {'count': len(entries)},
+            'response': {'keys': keys}}
+
+@app.post('/api/v1/batch/messages/get')
+async def get_messages(batch_data: BatchKeysModel, x_rclip_accept_encoding: Optional[str] = Header(None),
+                       x_rclip_namespace: Optional[str] = Header(None)):
+    keys = batch_data.keys
+    check_batch_size(len(keys))
+    entry_keys = Namespace(x_rclip_namespace, cluster).keys(keys)
+    entries = await storage.read_many(entry_keys, 'data', 'category', 'encoding') if keys else []
+    messages = []
+    for key, (message, category, encoding) in zip(keys, entries):
+        if message is None:
+            messages.append({'key': key, 'status': 404})
+        else:
+            response = message_response(key, message, category, encoding, x_rclip_accept_encoding)
+            response['status'] = 200
+            messages.append(response)
+    return {'request': {'keys': keys},
+            'response': {'messages': messages}}
+
+@app.post('/api/v1/batch/messages/delete')
+async def delete_messages(batch_data: BatchKeysModel, x_rclip_namespace: Optional[str] = Header(None)):
+    keys = batch_data.keys
+    check_batch_size(len(keys))
+    entry_keys = Namespace(x_rclip_namespace, cluster).keys(keys)
+    results = await storage.delete_many(entry_keys) if keys else []
+    await invalidate(entry_keys + [key for _, _, deleted in results for key in deleted[1:]])
+    size = sum(size for _, size, _ in results)
+    count_deleted(size)
+    return {'request': {'keys': keys},
+            'response': {'deleted': [key for key, (result, _, _) in zip(keys, results) if result == 1],
+                         'missing': [key for key, (result, _, _) in zip(keys, results) if result == 0],
+                         'bytes': size}}
+
+@app.post('/api/v1/batch/messages/ttl')
+async def set_messages_ttl(batch_data: BatchTTLModel, x_rclip_namespace: Optional[str] = Header(None)):
+    keys = batch_data.keys
+    ttl = batch_data.ttl
+    check_batch_size(len(keys))
+    entry_keys = Namespace(x_rclip_namespace, cluster).keys(keys)
+    results = await storage.set_ttl_many(entry_keys, ttl) if keys else []
+    await invalidate(entry_keys)
+    return {'request': {'keys': keys, 'ttl': ttl},
+            'response': {'updated': [key for key, result in zip(keys, results) if result == 1],
+                         'missing': [key for key, result in zip(keys, results) if result == -1]}}
 
 @app.post('/api/v1/files')
-async def post_file(file: UploadFile = File(...), x_ttl: Optional[int] = Header(None)):
-    data = file.file.read()
-    size = len(data)
+async def post_file(request: Request, x_ttl: Optional[int] = Header(None),
+                    x_chunk_hash: Optional[str] = Header(None),
+                    x_rclip_encoding: Optional[str] = Header(None),
+                    x_rclip_namespace: Optional[str] = Header(None)):
+    namespace = Namespace(x_rclip_namespace, cluster)
     if x_ttl is not None:
         ttl = x_ttl
     else:
         ttl = redis_ttl
-    key_src = str(file.filename) + ':' + str(time.time())
-    key = hashlib.blake2s(key_src.encode(), digest_size=int(key_width)).hexdigest()
-    redis.set(key, data)
-    redis.hset(key+'+hash', 'key_src', key_src)
-    redis.hset(key+'+hash', 'category', '__file__')
-    redis.hset(key+'+hash', 'size', size)
-    redis.expire(key, ttl)
-    redis.expire(key+'+hash', ttl)
+    # A fragment compressed by the client is stored compressed.  It is decoded
+    # as it streams in only to learn its size and check its chunk hash.
+    if x_rclip_encoding is not None and x_rclip_encoding not in available_encodings():
+        raise HTTPException(status_code=415, detail=f'Unsupported encoding {x_rclip_encoding}')
+    decoder = decompressor(x_rclip_encoding) if x_rclip_encoding is not None else None
+    raw_size = 0
+    # With X-Chunk-Hash the fragment is a content-addressed chunk stored under
+    # its sha256, which is verified while the body streams in.
+    if x_chunk_hash is not None and re.fullmatch('[0-9a-f]{64}', x_chunk_hash) is None:
+        raise HTTPException(status_code=422, detail='Invalid chunk hash')
+    digest = hashlib.sha256() if x_chunk_hash is not None else None
+    # The fragment is appended to a short-lived staging key in pieces of
+    # UPLOAD_PIECE_SIZE while it streams in and moved into its entry at the end.
+    # Once it outgrows BLOB_THRESHOLD what was staged moves to a blob writer,
+    # which takes the rest, and the entry gets the blob instead.
+    key_src = None
+    staging_key = None
+    writer = None
+    size = 0
+    buffer = bytearray()
+
+    # On a cluster the staging key has to share the slot of the entry, which
+    # only a chunk knows beforehand, so other fragments stay in the buffer
+    # until they are committed whole.
+    async def stage(piece):
+        # Returns False when the piece is to stay in the buffer.
+        nonlocal writer
+        if writer is None and blobs is not None and size > int(blob_threshold):
+            writer = blobs.create()
+            if staging_key is not None:
+                async with redis.pipeline(transaction=False) as pipe:
+                    pipe.get(staging_key)
+                    pipe.delete(staging_key)
+                    staged, _ = await pipe.execute()
+                writer.write(staged or b'')
+        if writer is not None:
+            writer.write(piece)
+        elif staging_key is not None:
+            async with redis.pipeline(transaction=False) as pipe:
+                pipe.append(staging_key, piece)
+                pipe.expire(staging_key, upload_timeout)
+                await pipe.execute()
+        else:
+            return False
+        return True
+
+    try:
+        async for filename, data in iter_file_upload(request):
+            if key_src is None:
+                key_src = str(filename) + ':' + str(time.time())
+                if digest is not None:
+                    staging_key = '+upload:' + hash_tag(namespace.key(x_chunk_hash)) + os.urandom(8).hex()
+                elif not cluster:
+                    staging_key = '+upload:' + os.urandom(8).hex()
+            size += len(data)
+            raw = data
+            if decoder is not None:
+                try:
+                    raw = decoder.decompress(data)
+                except Exception:
+                    raise HTTPException(status_code=422, detail=f'Invalid {x_rclip_encoding} data')
+            raw_size += len(raw)
+            if size > int(max_fragment_size) or raw_size > int(max_fragment_size):
+                raise HTTPException(status_code=413, detail=f'Fragment exceeds {max_fragment_size} bytes')
+            if digest is not None:
+                digest.update(raw)
+            buffer += data
+            if len(buffer) >= int(upload_piece_size) and await stage(bytes(buffer)):
+                buffer.clear()
+        if decoder is not None and not decoder.eof:
+            raise HTTPException(status_code=422, detail=f'Truncated {x_rclip_encoding} data')
+        if digest is not None and digest.hexdigest() != x_chunk_hash:
+            raise HTTPException(status_code=422, detail='Chunk hash mismatch')
+        fields = {'key_src': key_src, 'category': '__file__', 'size': size}
+        if not await stage(bytes(buffer)):
+            fields['data'] = bytes(buffer)
+        if x_rclip_encoding is not None:
+            fields.update({'encoding': x_rclip_encoding, 'raw_size': raw_size})
+        if writer is not None:
+            fields['blob'] = writer.blob_id
+        if digest is not None:
+            fields['refs'] = 0
+            key = x_chunk_hash
+            if writer is not None:
+                blobs.attach(writer, namespace.key(key))
+            if await storage.commit(staging_key, namespace.key(key), ttl, fields, chunk=True) != 1 \
+                    and writer is not None:
+                writer.discard()
+        else:
+            async def claim(key):
+                if writer is not None:
+                    blobs.attach(writer, namespace.key(key))
+                return await storage.commit(staging_key, namespace.key(key), ttl, fields) != -1
+            key = await allocator.allocate(key_src, claim)
+    except BaseException:
+        if staging_key is not None:
+            await redis.delete(staging_key)
+        if writer is not None:
+            writer.discard()
+        raise
     return {'request': {'size': size},
             'response': {'key': key, 'size': size}}
 
+@app.post('/api/v1/chunks')
+async def post_chunks(chunks_data: ChunksModel, x_ttl: Optional[int] = Header(None),
+                      x_rclip_namespace: Optional[str] = Header(None)):
+    namespace = Namespace(x_rclip_namespace, cluster)
+    hashes = list(dict.fromkeys(chunks_data.hashes))
+    if x_ttl is not None:
+        ttl = x_ttl
+    else:
+        ttl = redis_ttl
+    if any(re.fullmatch('[0-9a-f]{64}', h) is None for h in hashes):
+        raise HTTPException(status_code=422, detail='Invalid chunk hash')
+    present = await storage.claim_chunks(namespace.keys(hashes), ttl) if hashes else []
+    return {'request': {'hashes': hashes},
+            'response': {'present': [h for h, p in zip(hashes, present) if p == 1],
+                         'missing': [h for h, p in zip(hashes, present) if p == 0]}}
+
+def parse_range(range_header, size):
+    # Returns (start, end) inclusive for a single 'bytes=' range, None when the
+    # header should be ignored, and raises 416 when it cannot be satisfied.
+    if range_header is None:
+        return None
+    unit, _, spec = range_header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    try:
+        if first == '':
+            length = int(last)
+            if length <= 0:
+                raise ValueError
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last != '' else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise HTTPException(status_code=416, headers={'Content-Range': f'bytes */{size}'})
+    return start, min(end, size - 1)
+
+async def iter_range(data, start, end):
+    piece = int(download_piece_size)
+    while start <= end:
+        yield data[start:min(start + piece, end + 1)]
+        start += piece
+
+async def iter_payload(key, start, end):
+    # Reads the payload key of a fragment slice by slice; a fragment deleted
+    # meanwhile ends the stream short.
+    piece = int(download_piece_size)
+    while start <= end:
+        data = await storage.read_payload(key, start, min(start + piece, end + 1) - 1)
+        if not data:
+            break
+        start += len(data)
+        yield data
+
+def iter_stored(key, data, start, end):
+    # Bytes start to end of what a fragment stores, from data when it was
+    # read already, its 'data' field or blob, else from its payload key.
+    if data is not None:
+        return iter_range(data, start, end)
+    return iter_payload(key, start, end)
+
+async def iter_decoded(stored, encoding, start, end):
+    # stored: the whole stored fragment in pieces.
+    decoder = decompressor(encoding)
+    offset = 0
+    async for data in stored:
+        data = decoder.decompress(data)
+        if offset + len(data) > start and offset <= end:
+            yield data[max(start - offset, 0):end - offset + 1]
+        offset += len(data)
+        if offset > end:
+            break
+
 @app.get('/api/v1/files/{key}')
-async def get_file(key: str):
-    if redis.exists(key) == 0:
+async def get_file(key: str, range_header: Optional[str] = Header(None, alias='range'),
+                   if_range: Optional[str] = Header(None),
+                   x_rclip_accept_encoding: Optional[str] = Header(None),
+                   x_rclip_namespace: Optional[str] = Header(None)):
+    # The fragment is streamed out in DOWNLOAD_PIECE_SIZE slices, each read
+    # from redis with GETRANGE as it is sent.  Its stored size comes with its
+    # metadata, so the first slice is the only other round trip.
+    entry_key = Namespace(x_rclip_namespace, cluster).key(key)
+    entry = await read_entry(entry_key)
+    data, blob, key_src, encoding, raw_size = \
+        entry['data'], entry['blob'], entry['key_src'], entry['encoding'], entry['raw_size']
+    if blob is not None:
+        data = blobs.read(entry_key, blob) if blobs is not None else None
+        if data is None:
+            raise HTTPException(status_code=404)
+    if entry['category'] is None:
         raise HTTPException(status_code=404)
-    data = redis.get(key)
-    return Response(content=data, media_type='application/octet-stream')
+    # A compressed fragment is sent as stored to clients accepting its
+    # encoding, and ranges then apply to the stored bytes.  Other clients get
+    # it decoded here.
+    headers = {'Accept-Ranges': 'bytes'}
+    stored_size = len(data) if data is not None else int(entry['size'] or 0)
+    size = stored_size
+    etag_src = key_src or key.encode()
+    if encoding is not None:
+        encoding = encoding.decode()
+        if encoding in parse_accept_encoding(x_rclip_accept_encoding):
+            headers['X-Rclip-Encoding'] = encoding
+            etag_src += b'+' + encoding.encode()
+        else:
+            size = int(raw_size)
+    etag = '"' + hashlib.blake2s(etag_src, digest_size=8).hexdigest() + '"'
+    headers['ETag'] = etag
+    byte_range = None
+    if if_range is None or if_range.strip() == etag:
+        byte_range = parse_range(range_header, size)
+    if byte_range is None:
+        start, end, status = 0, size - 1, 200
+    else:
+        start, end = byte_range
+        status = 206
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    headers['Content-Length'] = str(end - start + 1)
+    if encoding is not None and 'X-Rclip-Encoding' not in headers:
+        content = iter_decoded(iter_stored(entry_key, data, 0, stored_size - 1), encoding, start, end)
+    elif blob is not None and range_header is None and blobs.path(entry_key, blob) is not None:
+        # Sent with sendfile by servers offering the ASGI pathsend extension.
+        return FileResponse(blobs.path(entry_key, blob), headers=headers, media_type='application/octet-stream')
+    else:
+        content = iter_stored(entry_key, data, start, end)
+    return StreamingResponse(content, status_code=status,
+                             headers=headers, media_type='application/octet-stream')
 
-def set_ttl(key: str, ttl_data: TTLModel, category=None):
-    if redis.exists(key) == 0 or redis.exists(key+'+hash') == 0:
-        raise HTTPException(status_code=404)
-    if category is not None:
-        stored_category = redis.hget(key+'+hash', 'category')
-        if category != stored_category:
-            raise HTTPException(status_code=403)
+async def set_ttl(key: str, ttl_data: TTLModel, namespace, category=None):
     ttl = ttl_data.ttl
-    redis.expire(key, ttl)
-    redis.expire(key+'+hash', ttl)
+    entry_key = namespace.key(key)
+    result = await storage.set_ttl(entry_key, ttl, category)
+    await invalidate([entry_key])
+    if result == -1:
+        raise HTTPException(status_code=404)
+    if result == -2:
+        raise HTTPException(status_code=403)
     return {'request': {'key': key, 'ttl': ttl},
             'response': {'key': key, 'ttl': ttl}}
 
 @app.post('/api/v1/messages/{key}/ttl')
-async def set_message_ttl(key: str, ttl_data: TTLModel):
-    return set_ttl(key, ttl_data)
+async def set_message_ttl(key: str, ttl_data: TTLModel, x_rclip_namespace: Optional[str] = Header(None)):
+    return await set_ttl(key, ttl_data, Namespace(x_rclip_namespace, cluster))
 
 @app.post('/api/v1/files/{key}/ttl')
-async def set_file_ttl(key: str, ttl_data: TTLModel):
-    return set_ttl(key, ttl_data, category='__file__')
+async def set_file_ttl(key: str, ttl_data: TTLModel, x_rclip_namespace: Optional[str] = Header(None)):
+    return await set_ttl(key, ttl_data, Namespace(x_rclip_namespace, cluster), category='__file__')
+
+@app.post('/api/v1/manifests')
+async def post_manifest(manifest_data: ManifestModel, x_ttl: Optional[int] = Header(None),
+                        x_rclip_namespace: Optional[str] = Header(None)):
+    namespace = Namespace(x_rclip_namespace, cluster)
+    name = urllib.parse.quote(manifest_data.name)
+    keys = manifest_data.keys
+    if x_ttl is not None:
+        ttl = x_ttl
+    else:
+        ttl = redis_ttl
+    fragment_keys = namespace.keys(keys)
+    if metrics is not None:
+        metrics.manifest_fragments.observe(len(keys))
+    fragments = await storage.read_many(fragment_keys, 'category', 'size', 'raw_size')
+    for key, (category, size, raw_size) in zip(keys, fragments):
+        if category != b'__file__':
+            raise HTTPException(status_code=404, detail=f'Fragment {key} not found')
+    file_size = sum(int(raw_size or size) for _, size, raw_size in fragments)
+    message = ':'.join([name] + keys)
+    key_time = str(time.time())
+    key_src = message + ':' + key_time
+    fields = {'data': message, 'key_src': '*:' + key_time, 'category': category_file_fragment_list,
+              'size': len(message), 'file_size': file_size}
+    async def claim(key):
+        return await storage.create_manifest(namespace.key(key), ttl, fields, fragment_keys)
+    key = await allocator.allocate(key_src, claim)
+    return {'request': {'name': manifest_data.name, 'keys': keys},
+            'response': {'key': key, 'size': file_size}}
+
+async def iter_fragments(fragments, start, end):
+    # fragments: (key, size, stored size, encoding) of each.
+    offset = 0
+    for key, size, stored_size, encoding in fragments:
+        if offset + size > start and offset <= end:
+            fragment_start, fragment_end = max(start - offset, 0), min(end - offset, size - 1)
+            entry = await read_entry(key)
+            data, blob = entry['data'], entry['blob']
+            if blob is not None:
+                data = blobs.read(key, blob) if blobs is not None else None
+                if data is None:
+                    break
+            if entry['category'] is None:
+                break
+            if encoding is not None:
+                if data is not None:
+                    stored_size = len(data)
+                content = iter_decoded(iter_stored(key, data, 0, stored_size - 1), encoding.decode(),
+                                       fragment_start, fragment_end)
+            else:
+                content = iter_stored(key, data, fragment_start, fragment_end)
+            async for data in content:
+                yield data
+        offset += size
+
+@app.get('/api/v1/manifests/{key}')
+async def get_manifest(key: str, range_header: Optional[str] = Header(None, alias='range'),
+                       if_range: Optional[str] = Header(None),
+                       x_rclip_namespace: Optional[str] = Header(None)):
+    namespace = Namespace(x_rclip_namespace, cluster)
+    manifest, category, key_src = await storage.read(namespace.key(key), 'data', 'category', 'key_src')
+    if manifest is None or category != category_file_fragment_list.encode():
+        raise HTTPException(status_code=404)
+    name, *keys = manifest.decode('utf-8', 'replace').split(':')
+    fragment_keys = namespace.keys(keys)
+    fragments = []
+    entries = await storage.read_many(fragment_keys, 'category', 'size', 'encoding', 'raw_size')
+    for fragment_key, entry_key, (category, stored_size, encoding, raw_size) in zip(keys, fragment_keys, entries):
+        # An expired fragment would silently shorten the file.
+        if category is None:
+            raise HTTPException(status_code=410, detail=f'Fragment {fragment_key} expired')
+        fragment_size = int(raw_size) if encoding is not None else int(stored_size)
+        fragments.append((entry_key, fragment_size, int(stored_size), encoding))
+    size = sum(fragment[1] for fragment in fragments)
+    etag = message_etag(key, key_src)
+    headers = {'Accept-Ranges': 'bytes', 'ETag': etag,
+               'Content-Disposition': "attachment; filename*=UTF-8''" + name}
+    byte_range = None
+    if if_range is None or if_range.strip() == etag:
+        byte_range = parse_range(range_header, size)
+    if byte_range is None:
+        start, end, status = 0, size - 1, 200
+    else:
+        start, end = byte_range
+        status = 206
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    headers['Content-Length'] = str(end - start + 1)
+    return StreamingResponse(iter_fragments(fragments, start, end), status_code=status,
+                             headers=headers, media_type='application/octet-stream')
+
+async def manifest_operation(key, namespace, op, ttl=0):
+    # The fragments a manifest operation deletes or expires are invalidated
+    # with it.  Returns (keys touched or -1, bytes deleted).
+    count, size, touched = await storage.manifest(namespace.key(key), op, ttl)
+    await invalidate(touched)
+    return count, size
+
+@app.delete('/api/v1/manifests/{key}')
+async def delete_manifest(key: str, x_rclip_namespace: Optional[str] = Header(None)):
+    count, size = await manifest_operation(key, Namespace(x_rclip_namespace, cluster), 'del')
+    if count == -1:
+        raise HTTPException(status_code=404)
+    count_deleted(size)
+    return {'request': {'key': key},
+            'response': {'key': key, 'deleted': count, 'bytes': size}}
+
+@app.post('/api/v1/manifests/{key}/ttl')
+async def set_manifest_ttl(key: str, ttl_data: TTLModel, x_rclip_namespace: Optional[str] = Header(None)):
+    ttl = ttl_data.ttl
+    count, _ = await manifest_operation(key, Namespace(x_rclip_namespace, cluster), 'expire', ttl)
+    if count == -1:
+        raise HTTPException(status_code=404)
+    return {'request': {'key': key, 'ttl': ttl},
+            'response': {'key': key, 'ttl': ttl}}
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import os
+import time
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+    from prometheus_client.core import GaugeMetricFamily
+except ImportError:
+    prometheus_client = None
+
+# Under gunicorn every worker writes its samples to files in
+# PROMETHEUS_MULTIPROC_DIR and a scrape of any worker merges them all.  The
+# directory has to be set before prometheus_client is imported and emptied
+# when the server starts, which gunicorn_conf.py takes care of.
+
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+size_buckets = tuple(float(4 ** n) for n in range(3, 14))
+count_buckets = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+def available():
+    return prometheus_client is not None
+
+class Metrics:
+
+    def __init__(self):
+        self.request_duration = prometheus_client.Histogram(
+            'rclip_request_duration_seconds', 'Time spent serving a request',
+            ['method', 'route', 'status'], buckets=latency_buckets)
+        self.requests_in_progress = prometheus_client.Gauge(
+            'rclip_requests_in_progress', 'Requests being served',
+            ['method'], multiprocess_mode='livesum')
+        self.request_bytes = prometheus_client.Counter(
+            'rclip_request_bytes', 'Request body bytes received', ['route'])
+        self.response_bytes = prometheus_client.Counter(
+            'rclip_response_bytes', 'Response body bytes sent', ['route'])
+        self.payload_size = prometheus_client.Histogram(
+            'rclip_payload_size_bytes', 'Request and response body sizes',
+            ['route', 'direction'], buckets=size_buckets)
+        self.redis_duration = prometheus_client.Histogram(
+            'rclip_redis_command_duration_seconds', 'Redis round trip time by command',
+            ['command'], buckets=latency_buckets)
+        self.cache_lookups = prometheus_client.Counter(
+            'rclip_cache_lookups', 'Hot-key cache lookups by result (hit, miss, coalesced)', ['result'])
+        self.manifest_fragments = prometheus_client.Histogram(
+            'rclip_manifest_fragments', 'Fragments listed by each registered file manifest',
+            buckets=count_buckets)
+        self.deleted_bytes = prometheus_client.Counter(
+            'rclip_deleted_bytes', 'Stored bytes freed by deletes of messages, files and their fragments')
+
+    def instrument(self, redis):
+        # Every command, including EVALSHA for the storage scripts, goes
+        # through execute_command; a pipeline is one round trip at execute().
+        execute_command = redis.execute_command
+        pipeline = redis.pipeline
+        redis_duration = self.redis_duration
+
+        async def timed_execute_command(*args, **options):
+            start = time.perf_counter()
+            try:
+                return await execute_command(*args, **options)
+            finally:
+                redis_duration.labels(str(args[0]).upper()).observe(time.perf_counter() - start)
+
+        def timed_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+
+            async def timed_execute(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await execute(*args, **kwargs)
+                finally:
+                    redis_duration.labels('PIPELINE').observe(time.perf_counter() - start)
+
+            pipe.execute = timed_execute
+            return pipe
+
+        redis.execute_command = timed_execute_command
+        redis.pipeline = timed_pipeline
+
+    def generate(self, live_keys):
+        # The live key count is read from redis at scrape time rather than
+        # kept per worker.
+        if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+            registry = prometheus_client.CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = prometheus_client.REGISTRY
+        keys = prometheus_client.CollectorRegistry()
+        keys.register(LiveKeysCollector(live_keys))
+        return prometheus_client.generate_latest(registry) + prometheus_client.generate_latest(keys)
+
+    @property
+    def content_type(self):
+        return prometheus_client.CONTENT_TYPE_LATEST
+
+class LiveKeysCollector:
+
+    def __init__(self, live_keys):
+        self.live_keys = live_keys
+
+    def collect(self):
+        yield GaugeMetricFamily('rclip_live_keys', 'Keys in the redis database', value=self.live_keys)
+
+class MetricsMiddleware:
+    # Plain ASGI middleware so streamed uploads and downloads are counted as
+    # their bodies pass through, not buffered.  Routes are labelled by their
+    # path template, e.g. /api/v1/files/{key}, to keep the label set bounded.
+
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        method = scope['method']
+        received = 0
+        sent = 0
+        status = 500
+
+        async def counting_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+            return message
+
+        async def counting_send(message):
+            nonlocal sent, status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                sent += len(message.get('body', b''))
+            await send(message)
+
+        in_progress = self.metrics.requests_in_progress.labels(method)
+        in_progress.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            elapsed = time.perf_counter() - start
+            in_progress.dec()
+            route = scope.get('route')
+            path = getattr(route, 'path', 'unmatched')
+            self.metrics.request_duration.labels(method, path, str(status)).observe(elapsed)
+            self.metrics.request_bytes.labels(path).inc(received)
+            self.metrics.response_bytes.labels(path).inc(sent)
+            self.metrics.payload_size.labels(path, 'in').observe(received)
+            self.metrics.payload_size.labels(path, 'out').observe(sent)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+# Converts entries stored by older servers (a string plus a key+'+hash'
+# metadata hash) into the current layout, keeping their TTL, and indexes
+# the entries stored before namespaces kept an index.  The server does both
+# lazily as entries are touched, but a flush only deletes the entries it
+# finds indexed, so run this once after upgrading.  On a cluster
+# (REDIS_CLUSTER=on) every node is scanned.
+#
+#   $ docker exec rclipapi python migrate.py
+
+import asyncio
+import os
+
+from storage import Storage, connect, legacy_suffix
+
+redis_host = os.environ.get("REDIS_HOST", "localhost")
+redis_port = os.environ.get("REDIS_PORT", "6379")
+redis_cluster = os.environ.get("REDIS_CLUSTER", "off")
+
+async def migrate():
+    cluster = redis_cluster == 'on'
+    redis = connect(redis_host, int(redis_port), cluster)
+    storage = Storage(redis, cluster)
+    migrated = 0
+    async for meta_key in redis.scan_iter(match='*'+legacy_suffix, count=1000):
+        migrated += await storage.migrate(meta_key[:-len(legacy_suffix)])
+    checked = 0
+    async for key in redis.scan_iter(count=1000, _type='hash'):
+        if not key.startswith(b'rclip+') and not key.endswith(legacy_suffix.encode()):
+            await storage.migrate(key)
+            checked += 1
+    await redis.aclose()
+    print(f'migrated {migrated} entries, checked the index of {checked}')
+
+if __name__ == '__main__':
+    asyncio.run(migrate())
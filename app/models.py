@@ -1,11 +1,29 @@
 #!/usr/bin/env python3
 
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 
 class MessageModel(BaseModel):
     message: str
     category: Optional[str] = None
+    encoding: Optional[str] = None
 
 class TTLModel(BaseModel):
     ttl: Optional[int] = None
+
+class ManifestModel(BaseModel):
+    name: str
+    keys: List[str]
+
+class ChunksModel(BaseModel):
+    hashes: List[str]
+
+class BatchMessagesModel(BaseModel):
+    messages: List[MessageModel]
+
+class BatchKeysModel(BaseModel):
+    keys: List[str]
+
+class BatchTTLModel(BaseModel):
+    keys: List[str]
+    ttl: Optional[int] = None
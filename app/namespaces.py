@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+import re
+from fastapi import HTTPException
+
+from storage import entry_key, key_pattern
+
+# A namespace is a clipboard of its own, picked by the X-Rclip-Namespace
+# header, whose entries live under 'ns:<name>:<key>' while those of the
+# default namespace keep their bare key, with a hash tag before the key on a
+# redis cluster (see storage.py).  Only keys of the
+# form the server hands out are accepted, so no key reaches into another
+# namespace or at the server's own bookkeeping.
+
+namespace_pattern = re.compile('[A-Za-z0-9_.-]{1,64}')
+
+class Namespace:
+
+    def __init__(self, header, hash_tags=False):
+        if header is not None and namespace_pattern.fullmatch(header) is None:
+            raise HTTPException(status_code=422, detail='Invalid namespace')
+        self.name = header or ''
+        self.prefix = f'ns:{self.name}:' if self.name else ''
+        self.hash_tags = hash_tags
+
+    def key(self, key):
+        # The redis key of one key, 404 when the server cannot have made it.
+        if key_pattern.fullmatch(key) is None:
+            raise HTTPException(status_code=404)
+        return entry_key(self.prefix, key, self.hash_tags)
+
+    def keys(self, keys):
+        if any(key_pattern.fullmatch(key) is None for key in keys):
+            raise HTTPException(status_code=422, detail='Invalid key')
+        return [entry_key(self.prefix, key, self.hash_tags) for key in keys]
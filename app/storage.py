@@ -0,0 +1,795 @@
+#!/usr/bin/env python3
+
+import os
+import re
+from redis.asyncio import BlockingConnectionPool, Redis
+from redis.asyncio.cluster import RedisCluster
+from redis.exceptions import NoScriptError
+
+# Every entry is a redis hash under its key: the payload of a message in the
+# 'data' field next to its metadata ('key_src', 'category', 'size', and
+# 'encoding', 'raw_size' where they apply), so one EXPIRE or DEL covers it.  The payload of a file fragment is a string under key+'+data'
+# instead, which downloads read in slices with GETRANGE rather than whole,
+# and which the scripts expire and delete along with the hash.  A large
+# fragment has a 'blob' field naming its payload in the blob store instead.
+# Fragments stored by servers that kept their payload in 'data' are read as
+# they are.
+#
+# A content-addressed chunk has a 'refs' field counting the manifests that
+# list it, each named in a 'ref:<manifest key>' field holding the time in ms
+# it expires, so that a manifest expired rather than deleted
+# stops holding it without being told.  A reference is taken when a manifest
+# is registered, not when a client learns the chunk is stored, and until
+# then the chunk is 'held' for the send that is to list it for chunk_hold
+# seconds.  Chunks of older servers only have the count in 'refs'.
+#
+# Entries written by older servers still are a string under the key plus a
+# key+'+hash' metadata hash.  Every script below first converts such an entry
+# into the current layout, keeping its TTL, so they are migrated lazily as
+# they are touched; migrate.py converts the rest in bulk.
+#
+# The entries of namespace <name> live under 'ns:<name>:<key>' (bare keys for
+# the default namespace '') and are indexed by the scripts that create,
+# delete or expire them:
+#
+#   rclip+ns:<name>+index   zset of entry keys scored by expiry time in ms
+#   rclip+ns:<name>+sizes   hash of entry key to stored bytes
+#   rclip+ns:<name>         hash of 'keys' and 'bytes' totals
+#
+# Expired entries leave the totals when reaped, a couple per entry created and
+# all of them when the totals are read, so counting never scans the keyspace.
+# A flush renames the index aside and deletes what it lists in batches.
+#
+# On a redis cluster every key a script touches has to be in one hash slot.
+# An entry key then starts with the hash tag of its first two characters,
+# 'ns:<name>:{a1}a1b2c3d4', and the index, sizes and totals above are kept
+# per tag, 'rclip+ns:<name>+index{a1}', so that an entry and its bookkeeping
+# share a slot while the entries, and so the fragments of a file, spread
+# over 256 tags across the shards.  Operations on several entries, such as
+# a manifest and its fragments, are pipelines of one script call per entry
+# there, where a single redis runs them in one script.
+
+legacy_suffix = '+hash'
+payload_suffix = '+data'
+flushes_key = 'rclip+flushes'
+cluster_tags = ['{%02x}' % i for i in range(256)]
+# Keys the server hands out; anything else is not an entry.
+key_pattern = re.compile('[0-9a-f]{1,64}')
+
+def connect(host, port, cluster=False, pool_size=50, pool_timeout=20, socket_timeout=10, connect_timeout=5,
+            health_check_interval=30):
+    # Returns a client of the redis at host:port, or with cluster of the
+    # redis cluster it is a node of, with up to pool_size connections per
+    # node.  On a single redis a command waits up to pool_timeout seconds for
+    # a free connection instead of opening more.
+    if cluster:
+        return RedisCluster(host=host, port=port, max_connections=pool_size,
+                            socket_timeout=socket_timeout, socket_connect_timeout=connect_timeout,
+                            health_check_interval=health_check_interval)
+    pool = BlockingConnectionPool(host=host, port=port, max_connections=pool_size, timeout=pool_timeout,
+                                  socket_timeout=socket_timeout, socket_connect_timeout=connect_timeout,
+                                  health_check_interval=health_check_interval)
+    return Redis(connection_pool=pool)
+
+def entry_key(prefix, key, hash_tags=False):
+    return prefix + ('{' + key[:2] + '}' if hash_tags else '') + key
+
+def hash_tag(key):
+    # The hash tag of a redis key, '' without one.
+    match = re.search('{[^}]+}', key)
+    return match.group(0) if match else ''
+
+def namespace_keys(namespace, tag=''):
+    # Returns the index, sizes and totals keys of namespace for entries with
+    # hash tag tag.
+    base = f'rclip+ns:{namespace}'
+    return base + '+index' + tag, base + '+sizes' + tag, base + tag
+
+def flush_keys(namespace, flush_id, tag=''):
+    # Returns the index and sizes keys of a flush of namespace in progress.
+    base = f'rclip+ns:{namespace}+flush:{flush_id}'
+    return base + tag, base + '+sizes' + tag
+
+index_lua = """
+local function index_keys(key)
+    local base = 'rclip+ns:' .. (string.match(key, '^ns:([^:]+):') or '')
+    local tag = string.match(key, '{[^}]+}') or ''
+    return base .. '+index' .. tag, base .. '+sizes' .. tag, base .. tag
+end
+local function now_ms()
+    local t = redis.call('TIME')
+    return tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+end
+local function expires_at(key)
+    local pttl = redis.call('PTTL', key)
+    if pttl < 0 then
+        return '+inf'
+    end
+    return now_ms() + pttl
+end
+local function stored_bytes(key)
+    local size = redis.call('HSTRLEN', key, 'data')
+    if size == 0 then
+        size = redis.call('STRLEN', key .. '+data')
+    end
+    if size == 0 and redis.call('HEXISTS', key, 'blob') == 1 then
+        size = tonumber(redis.call('HGET', key, 'size') or '0')
+    end
+    return size
+end
+local function forget(index, sizes, totals, key)
+    local size = tonumber(redis.call('HGET', sizes, key) or '0')
+    redis.call('ZREM', index, key)
+    redis.call('HDEL', sizes, key)
+    redis.call('HINCRBY', totals, 'keys', -1)
+    redis.call('HINCRBY', totals, 'bytes', -size)
+end
+local function reap(index, sizes, totals, limit)
+    -- Forgets up to limit entries past their expiry time; those still alive
+    -- were given a longer TTL and are scored again.
+    local reaped = 0
+    for _, key in ipairs(redis.call('ZRANGEBYSCORE', index, '-inf', now_ms(), 'LIMIT', 0, limit)) do
+        if redis.call('EXISTS', key) == 1 then
+            redis.call('ZADD', index, expires_at(key), key)
+        else
+            forget(index, sizes, totals, key)
+            reaped = reaped + 1
+        end
+    end
+    return reaped
+end
+local function index_add(key)
+    -- A key gone or expiring, e.g. created with a TTL of 0, is not indexed.
+    local pttl = redis.call('PTTL', key)
+    if pttl == -2 or pttl == 0 then
+        return
+    end
+    local index, sizes, totals = index_keys(key)
+    reap(index, sizes, totals, 2)
+    local size = stored_bytes(key)
+    local change = size
+    if redis.call('ZADD', index, expires_at(key), key) == 1 then
+        redis.call('HINCRBY', totals, 'keys', 1)
+    else
+        change = size - tonumber(redis.call('HGET', sizes, key) or '0')
+    end
+    redis.call('HSET', sizes, key, size)
+    redis.call('HINCRBY', totals, 'bytes', change)
+end
+local function index_remove(key)
+    local index, sizes, totals = index_keys(key)
+    if redis.call('ZSCORE', index, key) then
+        forget(index, sizes, totals, key)
+    end
+end
+local function index_touch(key)
+    -- An entry not indexed yet, such as a chunk reused while a flush of its
+    -- namespace deletes the old index, is indexed afresh and kept.
+    local index = index_keys(key)
+    if redis.call('EXISTS', key) == 0 then
+        index_remove(key)
+    elseif redis.call('ZSCORE', index, key) then
+        redis.call('ZADD', index, expires_at(key), key)
+    else
+        index_add(key)
+    end
+end
+"""
+
+migrate_lua = index_lua + """
+local function migrate(key)
+    if redis.call('TYPE', key).ok ~= 'string' then
+        return 0
+    end
+    local pttl = redis.call('PTTL', key)
+    local meta = redis.call('HGETALL', key .. '+hash')
+    if redis.call('HGET', key .. '+hash', 'category') == '__file__' then
+        redis.call('RENAME', key, key .. '+data')
+        redis.call('DEL', key .. '+hash')
+        redis.call('HSET', key, unpack(meta))
+    else
+        local data = redis.call('GET', key)
+        redis.call('DEL', key, key .. '+hash')
+        redis.call('HSET', key, 'data', data, unpack(meta))
+    end
+    if pttl > 0 then
+        redis.call('PEXPIRE', key, pttl)
+        redis.call('PEXPIRE', key .. '+data', pttl)
+    end
+    index_add(key)
+    return 1
+end
+local function expire(key, ttl)
+    -- Expires the entry and its payload key; 1 when the entry exists.
+    redis.call('EXPIRE', key .. '+data', ttl)
+    return redis.call('EXPIRE', key, ttl)
+end
+local function extend(key, ttl)
+    local current = redis.call('TTL', key)
+    if current >= 0 and current < tonumber(ttl) then
+        expire(key, ttl)
+        index_touch(key)
+        return 1
+    end
+    return 0
+end
+local function hold(key, ttl, seconds)
+    -- Keeps a chunk about to be listed by a manifest for at least ttl, and
+    -- from deletes of other manifests for seconds.
+    extend(key, ttl)
+    local held = now_ms() + tonumber(seconds) * 1000
+    if held > tonumber(redis.call('HGET', key, 'held') or '0') then
+        redis.call('HSET', key, 'held', held)
+    end
+end
+local function reference(key, manifest, expiry)
+    -- Records that manifest lists the chunk until expiry, or that it no
+    -- longer does when expiry is false, forgetting manifests expired since.
+    -- Returns whether another manifest, or a send about to register one,
+    -- still holds the chunk.
+    local now = now_ms()
+    local own = 'ref:' .. manifest
+    local listed, others, found = 0, 0, false
+    for _, field in ipairs(redis.call('HKEYS', key)) do
+        if string.sub(field, 1, 4) == 'ref:' then
+            listed = listed + 1
+            if field == own then
+                found = true
+            else
+                local at = tonumber(redis.call('HGET', key, field))
+                if at <= now then
+                    redis.call('HDEL', key, field)
+                else
+                    others = others + 1
+                end
+            end
+        end
+    end
+    -- References counted by older servers name no manifest.
+    local unnamed = math.max(tonumber(redis.call('HGET', key, 'refs') or '0') - listed, 0)
+    if expiry then
+        redis.call('HSET', key, own, expiry)
+    else
+        redis.call('HDEL', key, own)
+        if not found and unnamed > 0 then
+            unnamed = unnamed - 1
+        end
+    end
+    redis.call('HSET', key, 'refs', others + unnamed + (expiry and 1 or 0))
+    return others + unnamed > 0 or tonumber(redis.call('HGET', key, 'held') or '0') > now
+end
+"""
+
+# Deletes go through unlink, whose UNLINK frees the memory of a large entry
+# off the redis main thread.
+unlink_lua = migrate_lua + """
+local function unlink(key)
+    -- Returns the bytes the entry stored, or false when it was gone.
+    local size = stored_bytes(key)
+    index_remove(key)
+    redis.call('UNLINK', key .. '+data')
+    if redis.call('UNLINK', key) == 1 then
+        return size
+    end
+    return false
+end
+"""
+
+# A manifest operation reaches the fragments of the manifest through
+# fragment(), called for each of them by the script of the manifest itself
+# on a single redis and by fragment_lua, one call per fragment in a pipeline,
+# on a cluster where they live on other shards.
+cascade_lua = unlink_lua + """
+local function fragment_keys(key, list)
+    -- The keys the fragment list of manifest key names, each once, in its
+    -- namespace.  A fragment list is only a message of its category, so names
+    -- that are not keys are skipped rather than let reach the server's own.
+    local prefix = string.match(key, '^(ns:[^:]+:)') or ''
+    local keys, seen, first = {}, {}, true
+    for name in string.gmatch(list .. ':', '([^:]*):') do
+        if first then
+            first = false
+        elseif not seen[name] and #name <= 64 and string.match(name, '^[0-9a-f]+$') then
+            seen[name] = true
+            keys[#keys + 1] = prefix .. name
+        end
+    end
+    return keys
+end
+local function take_reference(key, manifest, ttl)
+    -- Takes the reference of newly registered manifest on its fragment key
+    -- when it is a chunk, extending its TTL to at least that of manifest.
+    migrate(key)
+    if redis.call('HEXISTS', key, 'refs') == 1 then
+        reference(key, manifest, now_ms() + tonumber(ttl) * 1000)
+        extend(key, ttl)
+    end
+end
+local function fragment(key, op, ttl, manifest)
+    -- Applies op ('del' or 'expire') of manifest to its fragment key.  Keys
+    -- are handed out again once their entries expire, so keys that are not
+    -- file fragments, such as the messages of others, are left alone.
+    -- Content-addressed chunks still held by other manifests are only
+    -- dereferenced on delete and never have their TTL shortened.  Returns 1
+    -- when the key was touched, the bytes deleted and the key when deleted
+    -- or expired.
+    migrate(key)
+    if redis.call('HGET', key, 'category') ~= '__file__' then
+        return 0, 0
+    end
+    if redis.call('HEXISTS', key, 'refs') == 1 then
+        local expiry = op == 'expire' and now_ms() + tonumber(ttl) * 1000
+        if reference(key, manifest, expiry) then
+            if op == 'del' then
+                return 0, 0
+            end
+            return extend(key, ttl), 0
+        end
+    end
+    if op == 'del' then
+        local size = unlink(key)
+        if size then
+            return 1, size, key
+        end
+    elseif expire(key, ttl) == 1 then
+        index_touch(key)
+        return 1, 0, key
+    end
+    return 0, 0
+end
+local function cascade(key, list, op, ttl)
+    -- Applies op of manifest key to every fragment its list names.  Returns
+    -- the number of fragments touched, the bytes deleted and the keys
+    -- deleted or expired.
+    local count, size, keys = 0, 0, {}
+    for _, fragment_key in ipairs(fragment_keys(key, list)) do
+        local touched, freed, changed = fragment(fragment_key, op, ttl, key)
+        count = count + touched
+        size = size + freed
+        keys[#keys + 1] = changed
+    end
+    return count, size, keys
+end
+local function manifest_result(result, size, list, key, op, ttl, in_script)
+    -- The result of a manifest operation on key: result, the bytes deleted,
+    -- the fragment list when the caller is to cascade op itself ('' when it
+    -- was cascaded here or there is none), the fragments touched here and
+    -- the keys deleted or expired.
+    local reply = {result, size, list, 0, key}
+    if in_script and list ~= '' then
+        local count, freed, keys = cascade(key, list, op, ttl)
+        reply = {result, size + freed, '', count, key}
+        for _, changed in ipairs(keys) do
+            reply[#reply + 1] = changed
+        end
+    end
+    return reply
+end
+"""
+
+# KEYS: key  ARGV: fields
+read_lua = migrate_lua + """
+migrate(KEYS[1])
+return redis.call('HMGET', KEYS[1], unpack(ARGV))
+"""
+
+# KEYS: key  ARGV: fields
+# Like read_lua with the remaining TTL of the key in milliseconds appended.
+read_ttl_lua = migrate_lua + """
+migrate(KEYS[1])
+local values = redis.call('HMGET', KEYS[1], unpack(ARGV))
+values[#ARGV + 1] = redis.call('PTTL', KEYS[1])
+return values
+"""
+
+# KEYS: key  ARGV: ttl, field, value, ...
+# Creates the entry only if the key is free.  Returns 1 when created, 0 when
+# the key is taken.
+create_lua = index_lua + """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+index_add(KEYS[1])
+return 1
+"""
+
+# KEYS: manifest key  ARGV: ttl, field, value, ...
+# Like create_lua for a manifest, taking its references on the chunks it
+# lists in the same call on a single redis.
+create_manifest_lua = cascade_lua + """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+index_add(KEYS[1])
+for _, fragment_key in ipairs(fragment_keys(KEYS[1], redis.call('HGET', KEYS[1], 'data'))) do
+    take_reference(fragment_key, KEYS[1], ARGV[1])
+end
+return 1
+"""
+
+# KEYS: key  ARGV: required category ('' for any), '1' to delete the
+#                   fragments of a manifest here too
+# Returns 1 when deleted, 0 when missing or -2 on category mismatch, followed
+# by the rest of manifest_result, fragments included when deleted here.
+delete_lua = cascade_lua + """
+migrate(KEYS[1])
+local category = redis.call('HGET', KEYS[1], 'category')
+if not category then
+    return {0, 0, '', 0}
+end
+if ARGV[1] ~= '' and category ~= ARGV[1] then
+    return {-2, 0, '', 0}
+end
+local list = ''
+if category == 'file-fragment-list' then
+    list = redis.call('HGET', KEYS[1], 'data')
+end
+return manifest_result(1, unlink(KEYS[1]), list, KEYS[1], 'del', 0, ARGV[2] == '1')
+"""
+
+# KEYS: key  ARGV: ttl, required category ('' for any)
+# Returns 1 on success, -1 if the key is missing, -2 on category mismatch.
+set_ttl_lua = migrate_lua + """
+migrate(KEYS[1])
+local category = redis.call('HGET', KEYS[1], 'category')
+if not category then
+    return -1
+end
+if ARGV[2] ~= '' and category ~= ARGV[2] then
+    return -2
+end
+expire(KEYS[1], ARGV[1])
+index_touch(KEYS[1])
+return 1
+"""
+
+# KEYS: staging key, key  ARGV: ttl, seconds to hold a chunk ('' for other
+#                             fragments), payload, field, value, ...
+# Moves an uploaded payload into its entry if the key is free, renaming the
+# staging key to the payload key or, without one, writing the payload given;
+# an empty one with neither means the payload is a blob.  A chunk already
+# stored is held instead and the upload is dropped.  Returns 1 when the
+# entry was written, 0 when an existing chunk was reused, and -1 when the
+# key is taken and the upload kept for another key.
+commit_lua = migrate_lua + """
+migrate(KEYS[2])
+if ARGV[2] ~= '' and redis.call('HEXISTS', KEYS[2], 'refs') == 1 then
+    redis.call('DEL', KEYS[1])
+    hold(KEYS[2], ARGV[1], ARGV[2])
+    return 0
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return -1
+end
+redis.call('DEL', KEYS[2], KEYS[2] .. '+data')
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RENAME', KEYS[1], KEYS[2] .. '+data')
+elseif ARGV[3] ~= '' then
+    redis.call('SET', KEYS[2] .. '+data', ARGV[3])
+end
+redis.call('HSET', KEYS[2], unpack(ARGV, 4))
+if ARGV[2] ~= '' then
+    hold(KEYS[2], ARGV[1], ARGV[2])
+end
+expire(KEYS[2], ARGV[1])
+index_add(KEYS[2])
+return 1
+"""
+
+# KEYS: chunk key  ARGV: ttl, seconds to hold it
+# Returns 1 when the chunk is already stored, holding it for the manifest to
+# come, and 0 when it is to be uploaded.
+claim_chunk_lua = migrate_lua + """
+migrate(KEYS[1])
+if redis.call('HEXISTS', KEYS[1], 'refs') == 1 then
+    hold(KEYS[1], ARGV[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# KEYS: fragment key  ARGV: manifest key, ttl
+# take_reference on a cluster.
+reference_lua = cascade_lua + """
+take_reference(KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
+
+# KEYS: manifest key  ARGV: 'expire' or 'del', ttl, '1' to apply it to the
+#                            fragments here too
+# Applies the operation to the manifest.  Returns 1 when the key was deleted
+# or expired, 0 when it was not or -1 when it is not a manifest, followed by
+# the rest of manifest_result.
+manifest_lua = cascade_lua + """
+migrate(KEYS[1])
+local manifest = redis.call('HMGET', KEYS[1], 'data', 'category')
+if not manifest[1] or manifest[2] ~= 'file-fragment-list' then
+    return {-1, 0, '', 0}
+end
+if ARGV[1] == 'del' then
+    return manifest_result(1, unlink(KEYS[1]), manifest[1], KEYS[1], 'del', 0, ARGV[3] == '1')
+end
+if redis.call('EXPIRE', KEYS[1], ARGV[2]) == 0 then
+    return {0, 0, manifest[1], 0}
+end
+index_touch(KEYS[1])
+return manifest_result(1, 0, manifest[1], KEYS[1], 'expire', ARGV[2], ARGV[3] == '1')
+"""
+
+# KEYS: fragment key  ARGV: 'expire' or 'del', ttl, manifest key
+# fragment() on a cluster.
+fragment_lua = cascade_lua + """
+return {fragment(KEYS[1], ARGV[1], ARGV[2], ARGV[3])}
+"""
+
+# KEYS: key
+# Migrates an entry of an older server, or indexes one stored before entries
+# were indexed.  Returns 1 when it was migrated.
+migrate_one_lua = migrate_lua + """
+local migrated = migrate(KEYS[1])
+local index = index_keys(KEYS[1])
+if migrated == 0 and redis.call('TYPE', KEYS[1]).ok == 'hash' and not redis.call('ZSCORE', index, KEYS[1]) then
+    index_add(KEYS[1])
+end
+return migrated
+"""
+
+# KEYS: index, sizes, totals  ARGV: limit
+# Reaps up to limit expired entries and returns the keys and bytes totals of
+# the namespace and the number reaped.
+namespace_stats_lua = index_lua + """
+local reaped = reap(KEYS[1], KEYS[2], KEYS[3], tonumber(ARGV[1]))
+local totals = redis.call('HMGET', KEYS[3], 'keys', 'bytes')
+return {tonumber(totals[1] or '0'), tonumber(totals[2] or '0'), reaped}
+"""
+
+# KEYS: index, sizes, flush index, flush sizes
+# Sets the index of the namespace aside for a flush.  Returns 1, or 0 when
+# the namespace is empty.
+flush_start_lua = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('RENAME', KEYS[1], KEYS[3])
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('RENAME', KEYS[2], KEYS[4])
+end
+return 1
+"""
+
+# KEYS: flush index, flush sizes, totals, index  ARGV: limit
+# Deletes up to limit entries of a flush with UNLINK, which frees their
+# memory in the background, and takes them off the totals.  An entry indexed
+# again since the flush started is a new one and kept.  Returns the number
+# of entries left followed by the keys deleted.
+flush_batch_lua = index_lua + """
+local deleted = {0}
+for _, key in ipairs(redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)) do
+    if not redis.call('ZSCORE', KEYS[4], key) and redis.call('UNLINK', key) == 1 then
+        redis.call('UNLINK', key .. '+data')
+        deleted[#deleted + 1] = key
+    end
+    forget(KEYS[1], KEYS[2], KEYS[3], key)
+end
+deleted[1] = redis.call('ZCARD', KEYS[1])
+if deleted[1] == 0 then
+    redis.call('DEL', KEYS[2])
+end
+return deleted
+"""
+
+class Storage:
+    # With hash_tags the keys are those of a redis cluster, see above, and
+    # the bookkeeping of a namespace is read and flushed one tag at a time.
+    # A chunk is held for chunk_hold seconds for the manifest of the send
+    # that uploaded or claimed it.  The fragments of a manifest are updated
+    # by the script of the manifest on a single redis, in one atomic call,
+    # and by a pipeline following it on a cluster.
+
+    def __init__(self, redis, hash_tags=False, chunk_hold=600):
+        self.redis = redis
+        self.hash_tags = hash_tags
+        self.chunk_hold = chunk_hold
+        self.tags = cluster_tags if hash_tags else ['']
+        self.in_script = '' if hash_tags else '1'
+        self.read_script = redis.register_script(read_lua)
+        self.read_ttl_script = redis.register_script(read_ttl_lua)
+        self.create_script = redis.register_script(create_lua)
+        self.create_manifest_script = redis.register_script(create_manifest_lua)
+        self.delete_script = redis.register_script(delete_lua)
+        self.set_ttl_script = redis.register_script(set_ttl_lua)
+        self.commit_script = redis.register_script(commit_lua)
+        self.claim_chunk_script = redis.register_script(claim_chunk_lua)
+        self.reference_script = redis.register_script(reference_lua)
+        self.manifest_script = redis.register_script(manifest_lua)
+        self.fragment_script = redis.register_script(fragment_lua)
+        self.migrate_script = redis.register_script(migrate_one_lua)
+        self.namespace_stats_script = redis.register_script(namespace_stats_lua)
+        self.flush_start_script = redis.register_script(flush_start_lua)
+        self.flush_batch_script = redis.register_script(flush_batch_lua)
+
+    async def run_many(self, script, calls):
+        # Runs script once per (keys, args) of calls in one pipeline.  A
+        # cluster pipeline does not load a script a node is missing, e.g.
+        # after a failover, so it is loaded on every primary and the pipeline
+        # run again.
+        for attempt in range(2):
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for keys, args in calls:
+                    await script(keys=keys, args=args, client=pipe)
+                try:
+                    return await pipe.execute()
+                except NoScriptError:
+                    if attempt == 1:
+                        raise
+            await self.redis.script_load(script.script)
+
+    async def read(self, key, *fields):
+        return await self.read_script(keys=[key], args=list(fields), client=self.redis)
+
+    async def read_ttl(self, key, *fields):
+        *values, pttl = await self.read_ttl_script(keys=[key], args=list(fields), client=self.redis)
+        return values, pttl
+
+    async def read_many(self, keys, *fields):
+        return await self.run_many(self.read_script, [([key], list(fields)) for key in keys])
+
+    async def create(self, key, ttl, fields):
+        args = [ttl]
+        for field, value in fields.items():
+            args.extend([field, value])
+        return await self.create_script(keys=[key], args=args, client=self.redis) == 1
+
+    async def create_many(self, entries, ttl):
+        # entries: [(key, fields)]; returns whether each key was free.
+        calls = []
+        for key, fields in entries:
+            args = [ttl]
+            for field, value in fields.items():
+                args.extend([field, value])
+            calls.append(([key], args))
+        return [result == 1 for result in await self.run_many(self.create_script, calls)]
+
+    async def delete(self, key, category=None):
+        # Returns (result, bytes deleted, keys deleted), the fragments of a
+        # manifest included.
+        result = await self.delete_script(keys=[key], args=[category or '', self.in_script], client=self.redis)
+        result, size, deleted, _ = (await self.cascade([key], [result], 'del'))[0]
+        return result, size, deleted
+
+    async def delete_many(self, keys, category=None):
+        results = await self.run_many(self.delete_script, [([key], [category or '', self.in_script]) for key in keys])
+        return [(result, size, deleted) for result, size, deleted, _ in await self.cascade(keys, results, 'del')]
+
+    async def cascade(self, keys, results, op, ttl=0):
+        # Completes the results of delete_lua or manifest_lua on keys by
+        # applying op to the fragments of their manifests not updated by the
+        # scripts already, all in one pipeline.  Returns (result, bytes deleted, keys deleted or expired,
+        # fragments touched) of each.  A fragment list is only a message of
+        # its category, so names in it that are not keys are skipped rather
+        # than let reach the server's own keys.
+        completed = []
+        calls = []
+        for key, (result, size, manifest, count, *touched) in zip(keys, results):
+            fragments = []
+            if manifest:
+                prefix = re.match('(ns:[^:]+:)?', key).group(0)
+                names = manifest.decode('utf-8', 'replace').split(':')[1:]
+                fragments = [entry_key(prefix, name, self.hash_tags)
+                             for name in dict.fromkeys(names) if key_pattern.fullmatch(name)]
+            completed.append((result, size, [key.decode() for key in touched], count, fragments))
+            calls.extend(([fragment], [op, ttl, key]) for fragment in fragments)
+        fragment_results = iter(await self.run_many(self.fragment_script, calls) if calls else [])
+        cascaded = []
+        for result, size, touched, count, fragments in completed:
+            for _ in fragments:
+                fragment_count, fragment_size, *fragment_keys = next(fragment_results)
+                count += fragment_count
+                size += fragment_size
+                touched.extend(key.decode() for key in fragment_keys)
+            cascaded.append((result, size, touched, count))
+        return cascaded
+
+    async def set_ttl(self, key, ttl, category=None):
+        return await self.set_ttl_script(keys=[key], args=[ttl, category or ''], client=self.redis)
+
+    async def set_ttl_many(self, keys, ttl, category=None):
+        return await self.run_many(self.set_ttl_script, [([key], [ttl, category or '']) for key in keys])
+
+    async def commit(self, staging_key, key, ttl, fields, chunk=False):
+        # Without a staging key the payload, if any, is the 'data' of fields.
+        args = [ttl, self.chunk_hold if chunk else '', fields.get('data', b'')]
+        for field, value in fields.items():
+            if field != 'data':
+                args.extend([field, value])
+        if staging_key is None:
+            staging_key = '+upload:' + hash_tag(key)
+        return await self.commit_script(keys=[staging_key, key], args=args, client=self.redis)
+
+    async def claim_chunks(self, keys, ttl):
+        return await self.run_many(self.claim_chunk_script, [([key], [ttl, self.chunk_hold]) for key in keys])
+
+    async def create_manifest(self, key, ttl, fields, fragments):
+        # Creates the manifest key like create, taking its references on the
+        # chunks among its fragments.
+        args = [ttl]
+        for field, value in fields.items():
+            args.extend([field, value])
+        if not self.hash_tags:
+            return await self.create_manifest_script(keys=[key], args=args, client=self.redis) == 1
+        if await self.create_script(keys=[key], args=args, client=self.redis) != 1:
+            return False
+        calls = [([fragment], [key, ttl]) for fragment in dict.fromkeys(fragments)]
+        if calls:
+            await self.run_many(self.reference_script, calls)
+        return True
+
+    async def manifest(self, key, op, ttl=0):
+        # Applies op to the manifest key and every fragment it lists.
+        # Returns (keys touched or -1, bytes deleted, keys deleted or expired).
+        result = await self.manifest_script(keys=[key], args=[op, ttl, self.in_script], client=self.redis)
+        result, size, touched, count = (await self.cascade([key], [result], op, ttl))[0]
+        return (result + count if result != -1 else -1), size, touched
+
+    async def blobs_live(self, blobs):
+        # blobs: [(key, blob_id)]; returns whether each key still has the blob.
+        entries = await self.read_many([key for key, _ in blobs], 'blob')
+        return [blob is not None and blob.decode() == blob_id for (_, blob_id), (blob,) in zip(blobs, entries)]
+
+    async def migrate(self, key):
+        return await self.migrate_script(keys=[key], client=self.redis)
+
+    async def read_payload(self, key, start, end):
+        # Bytes start to end inclusive of the payload of a file fragment.
+        return await self.redis.getrange(key + payload_suffix, start, end)
+
+    async def namespace_stats(self, namespace, limit=1000, rounds=10):
+        # Returns (keys, bytes) of namespace, reaping expired entries in
+        # batches of limit per tag for at most rounds calls.
+        for _ in range(rounds):
+            results = await self.run_many(self.namespace_stats_script,
+                                          [(list(namespace_keys(namespace, tag)), [limit]) for tag in self.tags])
+            if all(reaped < limit for _, _, reaped in results):
+                break
+        return sum(keys for keys, _, _ in results), sum(size for _, size, _ in results)
+
+    async def start_flush(self, namespace):
+        # Returns the id of the flush now owning the entries of namespace, or
+        # None when it has none.  The flush is recorded first so that one cut
+        # short by a restart is resumed.
+        flush_id = os.urandom(8).hex()
+        member = f'{namespace} {flush_id}'
+        await self.redis.sadd(flushes_key, member)
+        calls = []
+        for tag in self.tags:
+            index, sizes, _ = namespace_keys(namespace, tag)
+            calls.append(([index, sizes, *flush_keys(namespace, flush_id, tag)], []))
+        if 1 not in await self.run_many(self.flush_start_script, calls):
+            await self.redis.srem(flushes_key, member)
+            return None
+        return flush_id
+
+    async def flush_batch(self, namespace, flush_id, limit):
+        # Returns (entries left, keys deleted) of a flush in progress,
+        # deleting up to limit entries of each tag.
+        calls = []
+        for tag in self.tags:
+            index, _, totals = namespace_keys(namespace, tag)
+            flush_index, flush_sizes = flush_keys(namespace, flush_id, tag)
+            calls.append(([flush_index, flush_sizes, totals, index], [limit]))
+        left = 0
+        deleted = []
+        for count, *keys in await self.run_many(self.flush_batch_script, calls):
+            left += count
+            deleted.extend(key.decode() for key in keys)
+        if left == 0:
+            await self.redis.srem(flushes_key, f'{namespace} {flush_id}')
+        return left, deleted
+
+    async def flushes(self):
+        # Returns (namespace, flush id) of every flush in progress.
+        return [tuple(member.decode().split(' ')) for member in await self.redis.smembers(flushes_key)]
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+from fastapi import Request, HTTPException
+
+try:
+    from python_multipart import MultipartParser
+    from python_multipart.multipart import parse_options_header
+except ImportError:
+    from multipart import MultipartParser
+    from multipart.multipart import parse_options_header
+
+async def iter_file_upload(request: Request, field_name='file'):
+    # Parse a multipart/form-data body straight off the socket and yield
+    # (filename, data) for each piece of the named file field as it arrives,
+    # so nothing but the current network chunk is ever held in memory.
+    content_type, options = parse_options_header(request.headers.get('content-type', ''))
+    if content_type != b'multipart/form-data' or b'boundary' not in options:
+        raise HTTPException(status_code=400, detail='multipart/form-data required')
+
+    part = {'header_field': b'', 'header_value': b'', 'headers': {}, 'name': None, 'filename': None}
+    pieces = []
+
+    def on_part_begin():
+        part.update({'headers': {}, 'name': None, 'filename': None})
+
+    def on_header_field(data, start, end):
+        part['header_field'] += data[start:end]
+
+    def on_header_value(data, start, end):
+        part['header_value'] += data[start:end]
+
+    def on_header_end():
+        part['headers'][part['header_field'].lower()] = part['header_value']
+        part['header_field'] = b''
+        part['header_value'] = b''
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(part['headers'].get(b'content-disposition', b''))
+        part['name'] = disposition.get(b'name', b'').decode('utf-8', 'replace')
+        if b'filename' in disposition:
+            part['filename'] = disposition[b'filename'].decode('utf-8', 'replace')
+        if part['name'] == field_name:
+            pieces.append((part['filename'], b''))
+
+    def on_part_data(data, start, end):
+        if part['name'] == field_name:
+            pieces.append((part['filename'], data[start:end]))
+
+    parser = MultipartParser(options[b'boundary'], callbacks={
+        'on_part_begin': on_part_begin,
+        'on_header_field': on_header_field,
+        'on_header_value': on_header_value,
+        'on_header_end': on_header_end,
+        'on_headers_finished': on_headers_finished,
+        'on_part_data': on_part_data
+    })
+
+    found = False
+    async for chunk in request.stream():
+        parser.write(chunk)
+        for filename, data in pieces:
+            found = True
+            yield filename, data
+        pieces.clear()
+    parser.finalize()
+
+    if not found:
+        raise HTTPException(status_code=422, detail=f'{field_name} field required')
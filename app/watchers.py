@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+class KeyWatcher:
+    # Wakes requests waiting on keys when redis reports a change to them.
+    # Each worker keeps one pubsub connection with a keyspace subscription per
+    # watched key, taken when its first waiter arrives and dropped with its
+    # last, so an idle waiter costs an event here and redis nothing more than
+    # the subscription.  Changes redis does not notify, or notifies on
+    # another node of a cluster, are published on channel with the key or '*'.
+    #
+    # Without keyspace notifications (notify-keyspace-events, see configure)
+    # waiters fall back to looking again every poll_interval seconds.
+
+    def __init__(self, redis, channel, db=0, poll_interval=None):
+        self.redis = redis
+        self.channel = channel
+        self.prefix = f'__keyspace@{db}__:'
+        self.poll_interval = poll_interval
+        self.pubsub = None
+        self.waiters = {}
+
+    async def configure(self, flags):
+        # Adds flags to notify-keyspace-events; False if redis refuses CONFIG.
+        try:
+            current = (await self.redis.config_get('notify-keyspace-events')).get('notify-keyspace-events', '')
+            if isinstance(current, bytes):
+                current = current.decode()
+            missing = ''.join(flag for flag in flags if flag not in current)
+            if missing:
+                await self.redis.config_set('notify-keyspace-events', current + missing)
+            return True
+        except Exception as e:
+            logging.warning(f'keyspace notifications not configured: {type(e).__name__} {e}')
+            return False
+
+    @asynccontextmanager
+    async def watch(self, key):
+        # Yields an asyncio.Event set on every change of key.  It is yielded
+        # at once, so that a read made inside is not held up by a slow or
+        # lost pubsub connection, and set again when redis confirms the
+        # subscription, so that a change in between is looked at too.
+        event = asyncio.Event()
+        waiters = self.waiters.setdefault(key, set())
+        waiters.add(event)
+        try:
+            if len(waiters) == 1:
+                await self.subscribe(key)
+            yield event
+        finally:
+            waiters.discard(event)
+            if not waiters:
+                del self.waiters[key]
+                await self.unsubscribe(key)
+
+    async def subscribe(self, key):
+        # Without a connection, or losing it, the key is subscribed to again
+        # with the others once run() reconnects.
+        if self.pubsub is not None:
+            try:
+                await self.pubsub.subscribe(self.prefix + key)
+            except Exception:
+                logging.exception('keyspace subscribe failed')
+
+    async def unsubscribe(self, key):
+        if self.pubsub is not None:
+            try:
+                await self.pubsub.unsubscribe(self.prefix + key)
+            except Exception:
+                logging.exception('keyspace unsubscribe failed')
+
+    def notify(self, keys):
+        for key in keys:
+            for event in self.waiters.get(key, ()):
+                event.set()
+
+    def notify_all(self):
+        self.notify(list(self.waiters))
+
+    async def publish(self, keys):
+        # Waiters only miss a wake-up if this fails, so it is not raised.
+        try:
+            await self.redis.publish(self.channel, ' '.join(keys))
+        except Exception as e:
+            logging.warning(f'watch publish failed: {type(e).__name__} {e}')
+
+    def dispatch(self, message):
+        if message['type'] not in ('message', 'subscribe'):
+            return
+        channel = message['channel'].decode()
+        if message['type'] == 'message' and channel == self.channel:
+            keys = message['data'].decode().split()
+            if '*' in keys:
+                self.notify_all()
+            else:
+                self.notify(keys)
+        elif channel.startswith(self.prefix):
+            self.notify([channel[len(self.prefix):]])
+
+    async def run(self):
+        while True:
+            try:
+                async with self.redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self.channel, *[self.prefix + key for key in self.waiters])
+                    self.pubsub = pubsub
+                    # Changes made while disconnected were not seen.
+                    self.notify_all()
+                    async for message in pubsub.listen():
+                        self.dispatch(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception('key watcher failed')
+            finally:
+                self.pubsub = None
+            await asyncio.sleep(1)
+
+    def stats(self):
+        return {'keys': len(self.waiters),
+                'waiters': sum(len(waiters) for waiters in self.waiters.values())}
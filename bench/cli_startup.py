@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Startup cost of the rclip command line, one command at a time: each is run
+# --count times as a fresh `python -X importtime rclip/rclip.py ...` against
+# the server bench/suite.py starts (or --api), and the wall time, the time
+# spent importing modules and the heavy modules loaded are reported.  Import
+# time is what a lazy import saves, so a command gaining one shows up here
+# before it shows up in wall time.
+#
+#   $ python3 bench/cli_startup.py --fake -o before.json
+#   $ python3 bench/cli_startup.py --fake -o after.json --compare before.json
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from suite import git_revision, percentile, root, start_server
+
+client = os.path.join(root, 'rclip', 'rclip.py')
+
+# Modules worth naming when a command loads them.
+heavy_modules = ['requests', 'urllib3', 'chardet', 'zstandard', 'http.client', 'concurrent.futures', 'hashlib',
+                 'subprocess']
+
+def run(api, arguments, stdin=None):
+    # Returns (wall seconds, import seconds, modules imported, stdout).
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', client, '--api', api] + arguments,
+                          input=stdin, capture_output=True)
+    elapsed = time.perf_counter() - start
+    imported = 0
+    modules = []
+    for line in proc.stderr.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        modules.append(name.strip())
+        imported += int(self_us)
+    return elapsed, imported / 1000000, modules, proc.stdout
+
+def commands(api, workdir):
+    # Each command, with what it needs set up once beforehand.
+    _, _, _, key = run(api, ['-t', 'startup'])
+    path = os.path.join(workdir, 'file.bin')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(100000))
+    _, _, _, file_key = run(api, ['-f', path])
+    return {
+        'help': (['--help'], None),
+        'ping': (['--ping'], None),
+        'send': (['-t', 'startup'], None),
+        'send-stdin': ([], b'startup\n'),
+        'receive': ([key.decode().strip()], None),
+        'delete-missing': (['-d', 'ffffffff'], None),
+        'send-file': (['-f', path], None),
+        'receive-file': ([file_key.decode().strip(), '-o', os.path.join(workdir, 'copy.bin'), '-F'], None)
+    }
+
+def measure(api, arguments, stdin, count):
+    walls = []
+    imports = []
+    modules = []
+    for _ in range(count):
+        wall, imported, modules, _ = run(api, arguments, stdin)
+        walls.append(wall)
+        imports.append(imported)
+    return {
+        'count': count,
+        'wall_p50_ms': percentile(walls, 0.5) * 1000,
+        'wall_mean_ms': statistics.mean(walls) * 1000,
+        'import_p50_ms': percentile(imports, 0.5) * 1000,
+        'modules': len(modules),
+        'heavy': [name for name in heavy_modules if name in modules]
+    }
+
+def compare(results, baseline):
+    # Positive changes are improvements: less time.
+    for name, result in results['commands'].items():
+        old = baseline.get('commands', {}).get(name)
+        if old is None:
+            continue
+        changes = []
+        for metric in ['wall_p50_ms', 'import_p50_ms']:
+            if old.get(metric):
+                changes.append(f'{metric} {(old[metric] - result[metric]) / old[metric] * 100:+.1f}%')
+        print(f'{name:15} ' + ' '.join(changes))
+
+def main():
+    parser = argparse.ArgumentParser(description='rclip command line startup benchmark')
+    parser.add_argument('--host', default=os.environ.get('REDIS_HOST', 'localhost'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('REDIS_PORT', '6379')))
+    parser.add_argument('--fake', action='store_true', help='use an in-process fakeredis server instead of redis')
+    parser.add_argument('--cluster', action='store_true', help='--host/--port is a node of a redis cluster')
+    parser.add_argument('--api', help='benchmark against a running server at this url instead of starting one')
+    parser.add_argument('-n', '--count', type=int, default=20, help='runs per command')
+    parser.add_argument('-o', '--output', default='cli-startup.json', help='JSON result file')
+    parser.add_argument('--compare', help='earlier JSON result file to compare with')
+    args = parser.parse_args()
+
+    server = None
+    if args.api:
+        api = args.api
+    else:
+        api, server, thread = start_server(args)
+
+    results = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'commands': {}
+    }
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for name, (arguments, stdin) in commands(api, workdir).items():
+                result = measure(api, arguments, stdin, args.count)
+                results['commands'][name] = result
+                print(f'{name:15} wall p50 {result["wall_p50_ms"]:7.1f}ms mean {result["wall_mean_ms"]:7.1f}ms'
+                      f' imports {result["import_p50_ms"]:7.1f}ms modules {result["modules"]:4}'
+                      f' {" ".join(result["heavy"])}')
+    finally:
+        if server is not None:
+            server.should_exit = True
+            thread.join()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Compare redis memory used by the old two-key layout (payload string plus a
+# key+'+hash' metadata hash) with the single-hash layout of app/storage.py,
+# bare and as the server stores it: created through Storage, along with the
+# namespace index and sizes entries that come with every message.  The
+# benchmark flushes the given database, so point it at a scratch one.
+#
+#   $ REDIS_HOST=localhost python3 bench/memory_layout.py -n 1000000 --db 15
+
+import argparse
+import asyncio
+import os
+import sys
+from redis.asyncio import Redis
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from storage import Storage
+
+async def used_memory(redis):
+    return (await redis.info('memory'))['used_memory']
+
+async def fill(redis, count, size, layout, batch=10000):
+    message = 'x' * size
+    if layout == 'indexed':
+        storage = Storage(redis)
+        for first in range(0, count, batch):
+            await storage.create_many([(f'{i:08x}', {'data': message, 'key_src': f'*:{i}.0', 'category': '__message__',
+                                                     'size': size})
+                                       for i in range(first, min(first + batch, count))], 3600)
+        return
+    for first in range(0, count, batch):
+        async with redis.pipeline(transaction=False) as pipe:
+            for i in range(first, min(first + batch, count)):
+                key = f'{i:08x}'
+                metadata = {'key_src': f'*:{i}.0', 'category': '__message__', 'size': size}
+                if layout == 'legacy':
+                    pipe.set(key, message, ex=3600)
+                    pipe.hset(key+'+hash', mapping=metadata)
+                    pipe.expire(key+'+hash', 3600)
+                else:
+                    pipe.hset(key, mapping={'data': message, **metadata})
+                    pipe.expire(key, 3600)
+            await pipe.execute()
+
+async def run(args):
+    redis = Redis(host=args.host, port=args.port, db=args.db)
+    results = {}
+    for layout in ['legacy', 'single', 'indexed']:
+        await redis.flushdb()
+        before = await used_memory(redis)
+        await fill(redis, args.count, args.size, layout)
+        results[layout] = await used_memory(redis) - before
+        print(f'{layout:7} {results[layout] / 2**20:10.1f} MiB  {results[layout] / args.count:7.1f} bytes/entry')
+    await redis.flushdb()
+    await redis.aclose()
+    print(f'saving  {(1 - results["single"] / results["legacy"]) * 100:.1f}% bare, '
+          f'{(1 - results["indexed"] / results["legacy"]) * 100:.1f}% indexed')
+    print(f'index   {(results["indexed"] - results["single"]) / args.count:.1f} bytes/entry')
+
+def main():
+    parser = argparse.ArgumentParser(description='redis storage layout memory benchmark')
+    parser.add_argument('--host', default=os.environ.get('REDIS_HOST', 'localhost'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('REDIS_PORT', '6379')))
+    parser.add_argument('--db', type=int, default=15, help='scratch database, flushed by the benchmark')
+    parser.add_argument('-n', '--count', type=int, default=1000000, help='live entries')
+    parser.add_argument('-s', '--size', type=int, default=20, help='message size in bytes')
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()
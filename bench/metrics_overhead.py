@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# Measure what METRICS=on costs per request: the app is driven in process
+# through httpx, first as is and then wrapped in the metrics middleware with
+# its redis client instrumented.  Needs httpx and prometheus_client.
+#
+#   $ REDIS_HOST=localhost python3 bench/metrics_overhead.py -n 5000
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+os.environ['METRICS'] = 'off'
+os.environ.pop('PROMETHEUS_MULTIPROC_DIR', None)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import httpx
+import main as server
+import metrics as prometheus_metrics
+
+async def measure(app, count, path, message):
+    latencies = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        for _ in range(count):
+            start = time.perf_counter()
+            # A refused request would be timed as a fast one.
+            if message is None:
+                (await client.get(path)).raise_for_status()
+            else:
+                response = (await client.post(path, json={'message': message})).raise_for_status()
+                (await client.get(path + '/' + response.json()['response']['key'])).raise_for_status()
+            latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return {
+        'mean': statistics.mean(latencies),
+        'p50': latencies[len(latencies) // 2],
+        'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    }
+
+async def run(args):
+    message = 'x' * args.size
+    workloads = [('ping', '/api/v1/clipboard', None), ('post+get', '/api/v1/messages', message)]
+    # Warm up connections, script caches and the allocator first.
+    for _, path, body in workloads:
+        await measure(server.app, max(args.count // 10, 1), path, body)
+    baseline = {name: await measure(server.app, args.count, path, body) for name, path, body in workloads}
+    metrics = prometheus_metrics.Metrics()
+    metrics.instrument(server.redis)
+    app = prometheus_metrics.MetricsMiddleware(server.app, metrics)
+    measured = {name: await measure(app, args.count, path, body) for name, path, body in workloads}
+    for name, _, _ in workloads:
+        for label, result in [('off', baseline[name]), ('on', measured[name])]:
+            print(f'{name:9} metrics {label:3} mean {result["mean"]:.3f}ms p50 {result["p50"]:.3f}ms p99 {result["p99"]:.3f}ms')
+        print(f'{name:9} overhead {(measured[name]["mean"] - baseline[name]["mean"]) * 1000:.1f}us per request')
+    await server.redis.aclose()
+
+def main():
+    parser = argparse.ArgumentParser(description='metrics overhead benchmark')
+    parser.add_argument('-n', '--count', type=int, default=2000, help='requests per workload')
+    parser.add_argument('-s', '--size', type=int, default=100, help='message size in bytes')
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# Compare the per-request redis latency of the old one-command-per-call
+# access pattern with the scripts the server runs, driven through
+# app/storage.py so the numbers follow the shipped code.  Entries go to the
+# namespace 'bench' and are deleted with its bookkeeping afterwards.
+#
+#   $ REDIS_HOST=localhost python3 bench/redis_roundtrips.py -n 2000 -s 1024
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from redis.asyncio import Redis
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from storage import Storage, namespace_keys
+
+namespace = 'bench'
+
+async def legacy_post(redis, key, message, ttl):
+    await redis.set(key, message)
+    await redis.hset(key+'+hash', 'key_src', '*:0')
+    await redis.hset(key+'+hash', 'category', '__message__')
+    await redis.hset(key+'+hash', 'size', len(message))
+    await redis.expire(key, ttl)
+    await redis.expire(key+'+hash', ttl)
+
+async def legacy_get(redis, key):
+    if await redis.exists(key) == 0:
+        return None
+    message = await redis.get(key)
+    await redis.hget(key+'+hash', 'category')
+    return message
+
+async def storage_post(storage, key, message, ttl):
+    await storage.create(key, ttl, {'data': message, 'key_src': '*:0', 'category': '__message__',
+                                    'size': len(message)})
+
+async def storage_get(storage, key):
+    message, _ = await storage.read(key, 'data', 'category')
+    return message
+
+async def measure(redis, client, post, get, count, message):
+    latencies = []
+    keys = [f'ns:{namespace}:{i:08x}' for i in range(count)]
+    for key in keys:
+        start = time.perf_counter()
+        await post(client, key, message, 60)
+        await get(client, key)
+        latencies.append((time.perf_counter() - start) * 1000)
+    await redis.delete(*keys, *[key + '+hash' for key in keys], *namespace_keys(namespace))
+    latencies.sort()
+    return {
+        'mean': statistics.mean(latencies),
+        'p50': latencies[len(latencies) // 2],
+        'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    }
+
+async def run(args):
+    redis = Redis(host=args.host, port=args.port)
+    storage = Storage(redis)
+    message = 'x' * args.size
+    for name, client, post, get in [('legacy', redis, legacy_post, legacy_get),
+                                    ('storage', storage, storage_post, storage_get)]:
+        result = await measure(redis, client, post, get, args.count, message)
+        print(f'{name:10} post+get mean {result["mean"]:.3f}ms p50 {result["p50"]:.3f}ms p99 {result["p99"]:.3f}ms')
+    await redis.aclose()
+
+def main():
+    parser = argparse.ArgumentParser(description='redis round trip benchmark')
+    parser.add_argument('--host', default=os.environ.get('REDIS_HOST', 'localhost'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('REDIS_PORT', '6379')))
+    parser.add_argument('-n', '--count', type=int, default=1000, help='requests per pattern')
+    parser.add_argument('-s', '--size', type=int, default=100, help='message size in bytes')
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+# End-to-end benchmark of the server and the rclip client.  The FastAPI app is
+# started in this process with uvicorn, against redis at --host/--port (a
+# node of a redis cluster with --cluster) or, with --fake, an in-process
+# fakeredis server, and driven through the client
+# functions of rclip/rclip.py over real HTTP:
+#
+#   messages  post and get of messages of each --message-sizes, through the
+#             raw message api or, with --no-raw, the JSON one
+#   batch     the messages workload through the batch endpoints, timed per
+#             item
+#   files     send and receive of files of each --file-sizes cut at each
+#             --chunk-sizes, fresh random content every round
+#   mixed     --concurrency threads posting/getting messages and small files
+#
+# Throughput, p50/p99 latency and peak RSS (server and client together unless
+# --api points at a separate server) are printed and written to --output as
+# JSON; --compare prints the change against an earlier result file.
+#
+#   $ python3 bench/suite.py --fake -o before.json
+#   $ python3 bench/suite.py --fake -o after.json --compare before.json
+
+import argparse
+import concurrent.futures
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urljoin
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+
+from rclip import rclip
+
+def percentile(latencies, fraction):
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+def summarize(latencies, elapsed, nbytes=0):
+    result = {
+        'count': len(latencies),
+        'ops_per_sec': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_rss_kb': peak_rss()
+    }
+    if nbytes:
+        result['mb_per_sec'] = nbytes / elapsed / 1000000 if elapsed > 0 else 0.0
+    return result
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def parse_sizes(text):
+    units = {'k': 1024, 'm': 1024 * 1024}
+    sizes = []
+    for token in text.split(','):
+        token = token.strip().lower()
+        sizes.append(int(token[:-1]) * units[token[-1]] if token[-1] in units else int(token))
+    return sizes
+
+def check(status, message):
+    if status != 0 and status != rclip.rclip_status_file_fragment_list:
+        raise RuntimeError(message)
+    return message
+
+def start_server(args):
+    # The app reads its settings at import, so they are set beforehand.
+    os.environ['REDIS_HOST'] = args.host
+    os.environ['REDIS_PORT'] = str(args.port)
+    os.environ['REDIS_CLUSTER'] = 'on' if args.cluster else 'off'
+    os.environ['REDIS_TTL'] = '600'
+    sys.path.insert(0, os.path.join(root, 'app'))
+    import uvicorn
+    import main as server
+
+    if args.fake:
+        import fakeredis
+        # Every script, pipeline and allocator goes through server.redis, so
+        # pointing its connection pool at the fake server is enough.
+        server.redis.connection_pool = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer()).connection_pool
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    config = uvicorn.Config(server.app, host='127.0.0.1', port=port, log_level='warning')
+    uvicorn_server = uvicorn.Server(config)
+    thread = threading.Thread(target=uvicorn_server.run, daemon=True)
+    thread.start()
+    while not uvicorn_server.started:
+        if not thread.is_alive():
+            raise RuntimeError('server failed to start')
+        time.sleep(0.05)
+    return f'http://127.0.0.1:{port}/', uvicorn_server, thread
+
+def messages_url(api, args):
+    # Single messages go through the raw message api, as rclip sends them.
+    return urljoin(api, 'api/v1/messages' if args.no_raw else 'api/v1/raw/messages')
+
+def bench_messages(api, args):
+    url = messages_url(api, args)
+    results = {}
+    for size in parse_sizes(args.message_sizes):
+        message = ''.join(random.choices('abcdefghijklmnopqrstuvwxyz0123456789 \n', k=size))
+        keys = []
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(args.count):
+            t = time.perf_counter()
+            keys.append(check(*rclip.send(url, message, compression=not args.no_compress, raw=not args.no_raw)))
+            latencies.append(time.perf_counter() - t)
+        results[f'post/{size}'] = summarize(latencies, time.perf_counter() - start, size * args.count)
+        latencies = []
+        start = time.perf_counter()
+        for key in keys:
+            t = time.perf_counter()
+            check(*rclip.receive(url + '/' + key, raw=not args.no_raw))
+            latencies.append(time.perf_counter() - t)
+        results[f'get/{size}'] = summarize(latencies, time.perf_counter() - start, size * args.count)
+    return results
+
+def bench_batch(api, args):
+    url = urljoin(api, 'api/v1/batch/messages')
+    results = {}
+    for size in parse_sizes(args.message_sizes):
+        messages = [''.join(random.choices('abcdefghijklmnopqrstuvwxyz0123456789 \n', k=size))
+                    for _ in range(args.count)]
+        start = time.perf_counter()
+        keys = check(*rclip.send_batch(url, messages, compression=not args.no_compress))
+        elapsed = time.perf_counter() - start
+        results[f'post/{size}'] = summarize([elapsed / len(keys)] * len(keys), elapsed, size * len(keys))
+        start = time.perf_counter()
+        check(*rclip.receive_batch(url + '/get', keys))
+        elapsed = time.perf_counter() - start
+        results[f'get/{size}'] = summarize([elapsed / len(keys)] * len(keys), elapsed, size * len(keys))
+    return results
+
+def send_and_receive(api, args, workdir, size, chunk_size):
+    # Returns the send and receive latencies of one fresh file.
+    source = os.path.join(workdir, 'source')
+    with open(source, 'wb') as f:
+        f.write(os.urandom(size))
+    chunks_url = None if args.no_dedup else urljoin(api, 'api/v1/chunks')
+    t = time.perf_counter()
+    key = check(*rclip.send_file(urljoin(api, 'api/v1/files'), urljoin(api, 'api/v1/manifests'), source,
+                                 chunk_size=chunk_size, jobs=args.jobs, url_chunks=chunks_url,
+                                 compression=not args.no_compress))
+    sent = time.perf_counter() - t
+    t = time.perf_counter()
+    keys_string = check(*rclip.receive(messages_url(api, args) + '/' + key, raw=not args.no_raw))
+    check(*rclip.receive_file(urljoin(api, 'api/v1/files'), os.path.join(workdir, 'received'), keys_string,
+                              force=True, jobs=args.jobs, url_manifest=urljoin(api, 'api/v1/manifests/' + key)))
+    received = time.perf_counter() - t
+    if os.path.getsize(os.path.join(workdir, 'received')) != size:
+        raise RuntimeError(f'received file size differs from {size}')
+    return sent, received
+
+def bench_files(api, args):
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in parse_sizes(args.file_sizes):
+            for chunk_size in parse_sizes(args.chunk_sizes):
+                sends = []
+                receives = []
+                for _ in range(args.rounds):
+                    sent, received = send_and_receive(api, args, workdir, size, chunk_size)
+                    sends.append(sent)
+                    receives.append(received)
+                results[f'send/{size}/{chunk_size}'] = summarize(sends, sum(sends), size * len(sends))
+                results[f'receive/{size}/{chunk_size}'] = summarize(receives, sum(receives), size * len(receives))
+    return results
+
+def bench_mixed(api, args):
+    # Each worker runs its own mix for --duration seconds: mostly new
+    # messages, reads of earlier ones and now and then a small file.
+    url = messages_url(api, args)
+    file_size = parse_sizes(args.mixed_file_size)[0]
+    deadline = time.perf_counter() + args.duration
+
+    def worker(number):
+        latencies = {'post': [], 'get': [], 'file': []}
+        keys = []
+        rng = random.Random(number)
+        with tempfile.TemporaryDirectory() as workdir:
+            while time.perf_counter() < deadline:
+                choice = rng.random()
+                t = time.perf_counter()
+                if choice < 0.1:
+                    send_and_receive(api, args, workdir, file_size, file_size)
+                    latencies['file'].append(time.perf_counter() - t)
+                elif choice < 0.5 and keys:
+                    check(*rclip.receive(url + '/' + rng.choice(keys), raw=not args.no_raw))
+                    latencies['get'].append(time.perf_counter() - t)
+                else:
+                    keys.append(check(*rclip.send(url, 'x' * rng.randint(10, 4000), raw=not args.no_raw)))
+                    latencies['post'].append(time.perf_counter() - t)
+        return latencies
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        workers = list(executor.map(worker, range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    results = {}
+    for kind in ['post', 'get', 'file']:
+        latencies = [latency for latencies in workers for latency in latencies[kind]]
+        if latencies:
+            results[f'{kind}/c{args.concurrency}'] = summarize(latencies, elapsed)
+    everything = [latency for latencies in workers for kind in latencies.values() for latency in kind]
+    results[f'all/c{args.concurrency}'] = summarize(everything, elapsed)
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(results, baseline):
+    # Positive changes are improvements: more throughput, lower latency.
+    for workload, cases in results['workloads'].items():
+        for name, result in cases.items():
+            old = baseline.get('workloads', {}).get(workload, {}).get(name)
+            if old is None:
+                continue
+            changes = []
+            for metric, better in [('ops_per_sec', 1), ('mb_per_sec', 1), ('p50_ms', -1), ('p99_ms', -1)]:
+                if metric in result and old.get(metric):
+                    change = (result[metric] - old[metric]) / old[metric] * 100 * better
+                    changes.append(f'{metric} {change:+.1f}%')
+            print(f'{workload:8} {name:24} ' + ' '.join(changes))
+
+def report(workload, cases):
+    for name, result in cases.items():
+        throughput = f' {result["mb_per_sec"]:8.1f}MB/s' if 'mb_per_sec' in result else ' ' * 13
+        print(f'{workload:8} {name:24} {result["ops_per_sec"]:9.1f}ops/s{throughput}'
+              f' p50 {result["p50_ms"]:8.2f}ms p99 {result["p99_ms"]:8.2f}ms rss {result["peak_rss_kb"]}KB')
+
+def main():
+    parser = argparse.ArgumentParser(description='rclip server and client benchmark')
+    parser.add_argument('--host', default=os.environ.get('REDIS_HOST', 'localhost'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('REDIS_PORT', '6379')))
+    parser.add_argument('--fake', action='store_true', help='use an in-process fakeredis server instead of redis')
+    parser.add_argument('--cluster', action='store_true', help='--host/--port is a node of a redis cluster')
+    parser.add_argument('--api', help='benchmark a running server at this url instead of starting one')
+    parser.add_argument('-w', '--workloads', default='messages,batch,files,mixed', help='workloads to run')
+    parser.add_argument('-n', '--count', type=int, default=500, help='messages per size')
+    parser.add_argument('--message-sizes', default='100,10k,1m', help='message sizes')
+    parser.add_argument('--file-sizes', default='1m,16m,64m', help='file sizes')
+    parser.add_argument('--chunk-sizes', default='256k,1m,4m', help='fragment sizes')
+    parser.add_argument('-r', '--rounds', type=int, default=3, help='send/receive rounds per file size and chunk size')
+    parser.add_argument('-j', '--jobs', type=int, default=rclip.rclip_default_jobs, help='parallel fragment transfers')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='workers of the mixed workload')
+    parser.add_argument('-d', '--duration', type=float, default=10.0, help='seconds of the mixed workload')
+    parser.add_argument('--mixed-file-size', default='256k', help='file size of the mixed workload')
+    parser.add_argument('--no-compress', action='store_true', help='send messages and fragments uncompressed')
+    parser.add_argument('--no-dedup', action='store_true', help='upload every fragment')
+    parser.add_argument('--no-raw', action='store_true', help='send and receive single messages as JSON')
+    parser.add_argument('-o', '--output', default='bench-results.json', help='JSON result file')
+    parser.add_argument('--compare', help='earlier JSON result file to compare with')
+    args = parser.parse_args()
+
+    server = None
+    if args.api:
+        api = args.api
+    else:
+        api, server, thread = start_server(args)
+
+    workloads = {'messages': bench_messages, 'batch': bench_batch, 'files': bench_files, 'mixed': bench_mixed}
+    results = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'backend': args.api or ('fakeredis' if args.fake else f'redis://{args.host}:{args.port}'),
+        'arguments': vars(args),
+        'workloads': {}
+    }
+    try:
+        for workload in args.workloads.split(','):
+            cases = workloads[workload](api, args)
+            results['workloads'][workload] = cases
+            report(workload, cases)
+    finally:
+        if server is not None:
+            server.should_exit = True
+            thread.join()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
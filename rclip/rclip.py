@@ -1,25 +1,138 @@
 #!/usr/bin/env python3
 
 import argparse
-import chardet
+import base64
+import codecs
 import errno
 import io
 import json
 import os
-import requests
-import subprocess
+import re
 import sys
 import time
 import urllib.parse
+import zlib
 from argparse import RawDescriptionHelpFormatter
 from operator import attrgetter
 from urllib.parse import urljoin
-from subprocess import PIPE
+
+# requests, chardet and the modules only files, streams and pipes need are
+# imported where they are used: together they take several times longer to
+# load than the rest of the client, and sending or receiving one message
+# needs none of them.
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 rclip_category_file_fragment_list = 'file-fragment-list'
 rclip_status_file_fragment_list = 278
+rclip_fragment_retries = 3
+rclip_download_chunk_size = 65536
+rclip_default_jobs = 4
+rclip_chunk_query_size = 1000
+rclip_compress_min_size = 1024
+rclip_compress_min_ratio = 0.9
+rclip_batch_size = 500
+rclip_default_chunk_size = 1000000
+rclip_stream_name = '-'
+rclip_detect_sample_size = 65536
+rclip_pipe_chunk_size = 65536
+rclip_wait_poll = 60
+rclip_wait_min_hold = 1
+rclip_key_pattern = '[0-9a-f]{1,64}'
+rclip_retries = 5
+rclip_retry_statuses = (429, 503)
+rclip_retry_backoff = 0.5
+rclip_retry_max_delay = 30
 
 verbose = False
+namespace = None
+
+def available_encodings():
+    if zstandard is not None:
+        return ['zstd', 'gzip']
+    return ['gzip']
+
+def compress(data):
+    # Returns (encoding, compressed data), or (None, data) when the data is
+    # too small or does not compress well enough to be worth decoding later.
+    if len(data) < rclip_compress_min_size:
+        return None, data
+    encoding = available_encodings()[0]
+    if encoding == 'zstd':
+        compressed = zstandard.ZstdCompressor(level=3).compress(data)
+    else:
+        compressed = zlib.compress(data, level=6, wbits=zlib.MAX_WBITS | 16)
+    if len(compressed) > len(data) * rclip_compress_min_ratio:
+        return None, data
+    return encoding, compressed
+
+def decompressor(encoding):
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    elif encoding == 'gzip':
+        return zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    raise ValueError(f'Unsupported encoding {encoding}')
+
+def detect_encoding(sample):
+    # Valid UTF-8 is taken as is without further analysis; anything else is
+    # left to chardet, which only sees the first rclip_detect_sample_size
+    # bytes.  A multibyte character cut at the end of the sample is fine.
+    sample = sample[:rclip_detect_sample_size]
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    import chardet
+    encoding = chardet.detect(sample)['encoding']
+    if encoding == None:
+        encoding = 'utf-8'
+    return encoding
+
+def decode_stream(stream, encoding=None):
+    # Decodes a binary stream piece by piece.  Without an encoding it is
+    # detected from the first piece, and should UTF-8 turn out wrong further
+    # on, detected again from the piece where it fails.
+    parts = []
+    decoder = None
+    while True:
+        data = stream.read(rclip_pipe_chunk_size)
+        if decoder is None:
+            decoder = codecs.getincrementaldecoder(encoding or detect_encoding(data))()
+            detected = encoding is None
+        pending, _ = decoder.getstate()
+        try:
+            parts.append(decoder.decode(data, final=len(data) == 0))
+        except UnicodeDecodeError:
+            if not detected:
+                raise
+            data = pending + data
+            decoder = codecs.getincrementaldecoder(detect_encoding(data))()
+            detected = False
+            parts.append(decoder.decode(data, final=len(data) == 0))
+        if len(data) == 0:
+            break
+    return ''.join(parts)
+
+def open_input(pipe_input=None):
+    # Returns a binary stream of stdin or of the output of pipe_input, the
+    # process producing it and the file taking its stderr, which is not a
+    # pipe so that the process never blocks on it while its output is read.
+    if pipe_input is None:
+        return sys.stdin.buffer, None, None
+    import subprocess
+    import tempfile
+    errors = tempfile.TemporaryFile()
+    proc = subprocess.Popen(pipe_input, shell=True, stdout=subprocess.PIPE, stderr=errors)
+    return proc.stdout, proc, errors
+
+def read_errors(errors):
+    errors.seek(0)
+    err = errors.read()
+    return err.decode(detect_encoding(err), 'replace')
 
 def read_from_stdin(pipe_input=None, pipe_encoding=None):
     if pipe_input is None:
@@ -31,23 +144,39 @@ def read_from_stdin(pipe_input=None, pipe_encoding=None):
             out_message = f'{exception_name} {detail}'
             return None, errno.EIO, out_message
     else:
-        proc = subprocess.Popen(pipe_input, shell=True, stdout=PIPE, stderr=PIPE)
-        out, err = proc.communicate()
-        if proc.returncode > 0:
-            coding_err = chardet.detect(err)['encoding']
-            if coding_err == None:
-                coding_err = 'utf-8'
-            return None, proc.returncode, err.decode(coding_err)
-        if pipe_encoding:
-            coding = pipe_encoding
-        else:
-            coding = chardet.detect(out)['encoding']
-            if coding == None:
-                coding = 'utf-8'
-        message = out.decode(coding)
+        stream, proc, errors = open_input(pipe_input)
+        try:
+            message = decode_stream(stream, pipe_encoding)
+        except Exception as e:
+            proc.kill()
+            proc.wait()
+            exception_name = type(e).__name__
+            detail = str(e)
+            out_message = f'{exception_name} {detail}'
+            return None, errno.EIO, out_message
+        stream.close()
+        if proc.wait() > 0:
+            return None, proc.returncode, read_errors(errors)
 
     return message, 0, None
 
+def open_output(pipe_output):
+    # Starts pipe_output reading from a pipe of ours; what it prints is
+    # discarded and its stderr kept for -v.
+    import subprocess
+    import tempfile
+    errors = tempfile.TemporaryFile()
+    proc = subprocess.Popen(pipe_output, shell=True, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=errors)
+    return proc, errors
+
+def close_output(proc, errors):
+    try:
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass
+    if proc.wait() > 0 and verbose:
+        print(f'pipe: {read_errors(errors)}', file=sys.stderr)
+
 def write_to_stdout(message, method, pipe_output=None, pipe_encoding=None, no_r_stdout=False, no_s_pipe=False):
     if message is not None:
 
@@ -56,33 +185,112 @@ def write_to_stdout(message, method, pipe_output=None, pipe_encoding=None, no_r_
 
         if method != 'send' or no_s_pipe != True:
             if pipe_output is not None:
-                fifo_name = f'named_pipe.{os.path.basename(sys.argv[0])}.{os.getpid()}.{time.time()}'
-                os.mkfifo(fifo_name, mode=0o777)
-
-                fifo_in = os.open(fifo_name, os.O_RDONLY | os.O_NONBLOCK)
-                proc = subprocess.Popen(pipe_output, shell=True, stdin=fifo_in, stdout=PIPE, stderr=PIPE, text=True)
-                os.close(fifo_in)
-
+                # The message is encoded and fed to the command a slice at a
+                # time while it runs.
                 if pipe_encoding:
                     coding = pipe_encoding
                 else:
                     coding = 'utf-8'
+                encoder = codecs.getincrementalencoder(coding)()
 
-                fifo_out = os.open(fifo_name, os.O_WRONLY)
-                os.write(fifo_out, bytes(message, coding))
-                os.close(fifo_out)
-
-                out, err = proc.communicate()
-                if proc.returncode > 0:
-                    if verbose:
-                        coding_err = chardet.detect(err)['encoding']
-                        if coding_err == None:
-                            coding_err = 'utf-8'
-                        print(f'pipe: {err.decode(coding_err)}', file=sys.stderr)
-
-                os.unlink(fifo_name)
-
-def send(url, message, ttl=None, control_message=False):
+                proc, errors = open_output(pipe_output)
+                try:
+                    for start in range(0, len(message), rclip_pipe_chunk_size):
+                        proc.stdin.write(encoder.encode(message[start:start + rclip_pipe_chunk_size]))
+                    proc.stdin.write(encoder.encode('', final=True))
+                except BrokenPipeError:
+                    pass
+                close_output(proc, errors)
+
+def lean_http(url):
+    # Whether http.client can stand in for requests: plain http with no
+    # proxy and no credentials, in the url or in a netrc file, to apply.
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme != 'http' or parts.username is not None:
+        return False
+    if any(name.lower().endswith('_proxy') for name in os.environ):
+        return False
+    if os.environ.get('NETRC') is not None:
+        return False
+    return not any(os.path.exists(os.path.expanduser(f'~/{name}')) for name in ['.netrc', '_netrc'])
+
+class LeanResponse:
+    # The part of a requests response the single request commands read.
+
+    def __init__(self, res):
+        self.status_code = res.status
+        self.headers = res.headers
+        self.content = res.read()
+        self.encoding = res.headers.get_content_charset()
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', 'replace')
+
+def namespace_headers(headers=None):
+    headers = dict(headers or {})
+    if namespace:
+        headers.update({
+            'X-Rclip-Namespace': namespace
+        })
+    return headers
+
+def retry_delay(res, attempt):
+    # Seconds to wait before retrying a refused request: its Retry-After,
+    # otherwise a backoff doubling with each attempt.
+    retry_after = res.headers.get('Retry-After')
+    if retry_after is not None and retry_after.isdigit():
+        delay = int(retry_after)
+    else:
+        delay = rclip_retry_backoff * 2 ** attempt
+    return min(delay, rclip_retry_max_delay)
+
+def http_request(method, url, json_data=None, headers=None, body=None):
+    # One request without a session, made again after a pause while the
+    # server refuses it as too busy.
+    for attempt in range(rclip_retries + 1):
+        res = http_request_once(method, url, json_data, headers, body)
+        if res.status_code not in rclip_retry_statuses or attempt == rclip_retries:
+            return res
+        delay = retry_delay(res, attempt)
+        if verbose:
+            print(f'{method} {url}: {res.status_code}, retrying in {delay}s', file=sys.stderr)
+        time.sleep(delay)
+
+def http_request_once(method, url, json_data=None, headers=None, body=None):
+    # Made with http.client when possible so that a single message never
+    # waits for requests to import.  body is sent as is, json_data as JSON.
+    # A redirect, e.g. of an http api to https, is made again with requests,
+    # which follows it as it always did.
+    headers = namespace_headers(headers)
+    if lean_http(url):
+        res = lean_request(method, url, json_data, headers, body)
+        if not 300 <= res.status_code < 400:
+            return res
+
+    import requests
+    return requests.request(method, url, json=json_data, data=body, headers=headers)
+
+def lean_request(method, url, json_data, headers, body):
+    import http.client
+    parts = urllib.parse.urlsplit(url)
+    headers = dict(headers)
+    if json_data is not None:
+        body = json.dumps(json_data).encode('utf-8')
+        headers.update({
+            'Content-Type': 'application/json'
+        })
+    conn = http.client.HTTPConnection(parts.hostname, parts.port)
+    try:
+        conn.request(method, urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, '')),
+                     body=body, headers=headers)
+        return LeanResponse(conn.getresponse())
+    finally:
+        conn.close()
+
+def send(url, message, ttl=None, control_message=False, compression=True, raw=False):
+    # With raw, url is the raw message API, which takes the message as the
+    # body and answers with its key alone.
     out_status = 0
     out_message = None
 
@@ -90,16 +298,15 @@ def send(url, message, ttl=None, control_message=False):
         out_message = 'No message'
         return errno.ENOENT, out_message
 
-    data = {
-        'message': message
-    }
+    body = message.encode('utf-8')
+    # Fragment lists are read by the server and sent plain.
+    encoding = None
+    if compression is True and control_message is False:
+        encoding, body = compress(body)
 
     category = None
     if control_message is True:
         category = rclip_category_file_fragment_list
-        data.update({
-            'category': category
-        })
 
     headers = {}
     if ttl is not None:
@@ -107,9 +314,38 @@ def send(url, message, ttl=None, control_message=False):
             'X-ttl': ttl
         })
 
+    data = None
+    if raw is True:
+        headers.update({
+            'Content-Type': 'text/plain; charset=utf-8'
+        })
+        if encoding is not None:
+            headers.update({
+                'Content-Type': 'application/octet-stream',
+                'X-Rclip-Encoding': encoding
+            })
+        if category is not None:
+            headers.update({
+                'X-Rclip-Category': urllib.parse.quote(category)
+            })
+    else:
+        data = {
+            'message': message
+        }
+        if encoding is not None:
+            data.update({
+                'message': base64.b64encode(body).decode('ascii'),
+                'encoding': encoding
+            })
+        if category is not None:
+            data.update({
+                'category': category
+            })
+        body = None
+
     res = None
     try:
-        res = requests.post(url, json=data, headers=headers)
+        res = http_request('POST', url, data, headers, body)
     except Exception as e:
         exception_name = type(e).__name__
         detail = str(e)
@@ -131,21 +367,27 @@ def send(url, message, ttl=None, control_message=False):
                 out_message = f'{status} {detail}'
             else:
                 out_message = f'{status} ({content_type})'
+        elif raw is True:
+            out_message = res.text
         else:
             out_message = text['response']['key']
 
     if verbose:
-        print(f'post url: {url}, ttl: {ttl}, category: {category}', file=sys.stderr)
+        print(f'post url: {url}, ttl: {ttl}, category: {category}, encoding: {encoding}', file=sys.stderr)
 
     return out_status, out_message
 
-def receive(url):
+def receive(url, raw=False):
     out_status = 0
     out_message = None
 
+    headers = {
+        'X-Rclip-Accept-Encoding': ', '.join(available_encodings())
+    }
+
     res = None
     try:
-        res = requests.get(url)
+        res = http_request('GET', url, headers=headers)
     except Exception as e:
         exception_name = type(e).__name__
         detail = str(e)
@@ -169,24 +411,111 @@ def receive(url):
                 out_message = f'{status} {detail}'
             else:
                 out_message = f'{status} ({content_type})'
+        elif raw is True:
+            out_status, out_message = decode_raw_message(res)
         else:
-            out_message = text['response']['message']
-            category = text['response']['category']
-            if category == rclip_category_file_fragment_list:
-                out_status = rclip_status_file_fragment_list
+            out_status, out_message = decode_message(text['response'])
 
     if verbose:
         print(f'get url: {url}', file=sys.stderr)
 
     return out_status, out_message
 
+def decode_message(response):
+    # Returns (status, message) of a message as the server returns it.
+    out_message = response['message']
+    encoding = response.get('encoding')
+    if encoding is not None:
+        decoder = decompressor(encoding)
+        out_message = decoder.decompress(base64.b64decode(out_message)).decode('utf-8')
+    if response['category'] == rclip_category_file_fragment_list:
+        return rclip_status_file_fragment_list, out_message
+    return 0, out_message
+
+def decode_raw_message(res):
+    # Returns (status, message) of a message as the raw message API returns it.
+    out_message = res.content
+    encoding = res.headers.get('X-Rclip-Encoding')
+    if encoding is not None:
+        out_message = decompressor(encoding).decompress(out_message)
+    out_message = out_message.decode('utf-8')
+    if urllib.parse.unquote(res.headers.get('X-Rclip-Category', '')) == rclip_category_file_fragment_list:
+        return rclip_status_file_fragment_list, out_message
+    return 0, out_message
+
+def wait_message(url, etag=None, timeout=None, raw=False):
+    # Waits for the message at url to appear or, given the etag of a version
+    # already seen, to be replaced or deleted.  Returns (status, message,
+    # etag): ENOENT once a seen message is deleted, ETIMEDOUT after timeout
+    # seconds, forever without.  Each request is held by the server for up to
+    # rclip_wait_poll seconds.  A server answering without holding it, such
+    # as one ignoring wait, is asked again after a pause doubling each time.
+    headers = {
+        'X-Rclip-Accept-Encoding': ', '.join(available_encodings())
+    }
+    if etag is not None:
+        headers.update({
+            'If-None-Match': etag
+        })
+
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    backoff = rclip_retry_backoff
+    while True:
+        wait = rclip_wait_poll
+        if deadline is not None:
+            wait = min(wait, deadline - time.monotonic())
+            if wait <= 0:
+                return errno.ETIMEDOUT, f'Timed out waiting for {url}', etag
+
+        started = time.monotonic()
+        try:
+            res = http_request('GET', f'{url}?wait={wait:g}', headers=headers)
+        except Exception as e:
+            exception_name = type(e).__name__
+            detail = str(e)
+            out_message = f'{exception_name} {detail}'
+            return errno.EIO, out_message, etag
+
+        if verbose:
+            print(f'get url: {url}, wait: {wait:g}, status: {res.status_code}', file=sys.stderr)
+
+        status = res.status_code
+        if status == 304 or (status == 404 and etag is None):
+            if time.monotonic() - started < min(wait, rclip_wait_min_hold):
+                delay = min(backoff, rclip_retry_max_delay)
+                if deadline is not None:
+                    delay = min(delay, max(deadline - time.monotonic(), 0))
+                time.sleep(delay)
+                backoff *= 2
+            else:
+                backoff = rclip_retry_backoff
+            continue
+        content_type = res.headers['Content-Type']
+        if content_type != 'application/json':
+            text = None
+        else:
+            if res.encoding is None:
+                res.encoding = 'utf-8'
+            text = json.loads(res.text)
+
+        if status >= 400:
+            if text is not None:
+                detail = text['detail']
+                return errno.ENOENT, f'{status} {detail}', etag
+            return errno.ENOENT, f'{status} ({content_type})', etag
+        if raw is True:
+            out_status, out_message = decode_raw_message(res)
+        else:
+            out_status, out_message = decode_message(text['response'])
+        return out_status, out_message, res.headers['ETag']
+
 def delete(url):
     out_status = 0
     out_message = None
 
     res = None
     try:
-        res = requests.delete(url)
+        res = http_request('DELETE', url)
     except Exception as e:
         exception_name = type(e).__name__
         detail = str(e)
@@ -210,13 +539,296 @@ def delete(url):
                 out_message = f'{status} ({content_type})'
         else:
             out_message = f'{status}'
+            if verbose and text is not None:
+                # Deleting a file deletes its fragments on the server too.
+                response = text['response']
+                print(f'deleted: {response.get("deleted", 1)} keys, {response.get("bytes", 0)} bytes',
+                      file=sys.stderr)
 
     if verbose:
         print(f'del url: {url}', file=sys.stderr)
 
     return out_status, out_message
 
-def send_file(url, url_keys, filename, ttl=None, chunk_size = None):
+def post_batch(session, url, data, headers=None):
+    # Posts one batch request and returns (status, response) or
+    # (status, error message).
+    res = None
+    try:
+        res = session.post(url, json=data, headers=headers)
+    except Exception as e:
+        exception_name = type(e).__name__
+        detail = str(e)
+        out_message = f'{exception_name} {detail}'
+        return errno.EIO, out_message
+
+    status = res.status_code
+    content_type = res.headers['Content-Type']
+    if content_type != 'application/json':
+        text = None
+    else:
+        if res.encoding is None:
+            res.encoding = 'utf-8'
+        text = json.loads(res.text)
+
+    if verbose:
+        print(f'post url: {url}, items: {len(data.get("messages", data.get("keys", [])))}', file=sys.stderr)
+
+    if status >= 400:
+        if text is not None:
+            detail = text['detail']
+            return errno.ENOENT, f'{status} {detail}'
+        return errno.ENOENT, f'{status} ({content_type})'
+    return 0, text['response']
+
+def send_batch(url, messages, ttl=None, compression=True):
+    # Sends messages rclip_batch_size at a time and returns their keys in
+    # order.
+    headers = {}
+    if ttl is not None:
+        headers.update({
+            'X-ttl': ttl
+        })
+
+    keys = []
+    with new_session(1) as session:
+        for first in range(0, len(messages), rclip_batch_size):
+            items = []
+            for message in messages[first:first + rclip_batch_size]:
+                item = {'message': message}
+                if compression is True:
+                    encoding, compressed = compress(message.encode('utf-8'))
+                    if encoding is not None:
+                        item.update({
+                            'message': base64.b64encode(compressed).decode('ascii'),
+                            'encoding': encoding
+                        })
+                items.append(item)
+            status, response = post_batch(session, url, {'messages': items}, headers)
+            if status != 0:
+                return status, response
+            keys.extend(response['keys'])
+
+    return 0, keys
+
+def receive_batch(url, keys):
+    # Returns a (status, message) pair per key, as receive() would.
+    headers = {
+        'X-Rclip-Accept-Encoding': ', '.join(available_encodings())
+    }
+
+    results = []
+    with new_session(1) as session:
+        for first in range(0, len(keys), rclip_batch_size):
+            status, response = post_batch(session, url, {'keys': keys[first:first + rclip_batch_size]}, headers)
+            if status != 0:
+                return status, response
+            for item in response['messages']:
+                if item['status'] >= 400:
+                    results.append((errno.ENOENT, f'{item["key"]} {item["status"]} Not Found'))
+                    continue
+                results.append(decode_message(item))
+
+    return 0, results
+
+def delete_batch(url, keys):
+    # Returns a (status, message) pair per key, as delete() would.
+    results = []
+    with new_session(1) as session:
+        for first in range(0, len(keys), rclip_batch_size):
+            status, response = post_batch(session, url, {'keys': keys[first:first + rclip_batch_size]})
+            if status != 0:
+                return status, response
+            missing = set(response['missing'])
+            for key in keys[first:first + rclip_batch_size]:
+                if key in missing:
+                    results.append((errno.ENOENT, f'{key} 404 Not Found'))
+                else:
+                    results.append((0, f'{key} 200\n'))
+            if verbose:
+                print(f'deleted: {len(response["deleted"])} keys, {response.get("bytes", 0)} bytes',
+                      file=sys.stderr)
+
+    return 0, results
+
+def send_manifest(url, name, keys, ttl=None):
+    out_status = 0
+    out_message = None
+
+    data = {
+        'name': name,
+        'keys': keys
+    }
+
+    headers = {}
+    if ttl is not None:
+        headers.update({
+            'X-ttl': ttl
+        })
+
+    res = None
+    try:
+        res = http_request('POST', url, data, headers)
+    except Exception as e:
+        exception_name = type(e).__name__
+        detail = str(e)
+        out_message = f'{exception_name} {detail}'
+        return errno.EIO, out_message
+
+    if res is not None:
+        status = res.status_code
+        content_type = res.headers['Content-Type']
+        if content_type != 'application/json':
+            text = None
+        else:
+            text = json.loads(res.text)
+
+        if status >= 400:
+            out_status = errno.ENOENT
+            if text is not None:
+                detail = text['detail']
+                out_message = f'{status} {detail}'
+            else:
+                out_message = f'{status} ({content_type})'
+        else:
+            out_message = text['response']['key']
+
+    if verbose:
+        print(f'post url: {url}, ttl: {ttl}, fragments: {len(keys)}', file=sys.stderr)
+
+    return out_status, out_message
+
+def new_session(pool_size):
+    # Requests the server refuses as too busy are retried by the adapter
+    # after their Retry-After or a backoff, like http_request; a failed
+    # connection is not.
+    import requests
+    from urllib3.util.retry import Retry
+    session = requests.Session()
+    session.headers.update(namespace_headers())
+    retries = Retry(total=rclip_retries, connect=0, read=False, other=0, status_forcelist=rclip_retry_statuses,
+                    allowed_methods=None, backoff_factor=rclip_retry_backoff, raise_on_status=False)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def send_fragment(session, url, fileno, basename, file_number, offset, chunk_size, ttl=None, chunk_hash=None,
+                  compression=True):
+    data = os.pread(fileno, chunk_size, offset)
+    return send_fragment_data(session, url, data, basename, file_number, ttl, chunk_hash, compression)
+
+def send_fragment_data(session, url, data, basename, file_number, ttl=None, chunk_hash=None, compression=True):
+    sz = len(data)
+    encoding = None
+    if compression is True:
+        encoding, data = compress(data)
+    bd = io.BytesIO(data)
+
+    files = {
+        'file': (f'{basename}.{file_number}', bd, 'application/octet-stream')
+    }
+
+    headers = {}
+    if ttl is not None:
+        headers.update({
+            'X-ttl': ttl
+        })
+    if chunk_hash is not None:
+        headers.update({
+            'X-Chunk-Hash': chunk_hash
+        })
+    if encoding is not None:
+        headers.update({
+            'X-Rclip-Encoding': encoding
+        })
+
+    res = None
+    try:
+        res = session.post(url, files=files, headers=headers)
+    except Exception as e:
+        exception_name = type(e).__name__
+        detail = str(e)
+        return errno.EIO, f'#{file_number} {exception_name} {detail}'
+
+    status = res.status_code
+    content_type = res.headers['Content-Type']
+    if content_type != 'application/json':
+        text = None
+    else:
+        text = json.loads(res.text)
+
+    if status >= 400:
+        if text is not None:
+            detail = text['detail']
+            return errno.ENOENT, f'#{file_number} {status} {detail}'
+        else:
+            return errno.ENOENT, f'#{file_number} {status} ({content_type})'
+
+    if verbose:
+        print(f'post url: {url}, file: {basename}.{file_number}, length: {sz}, sent: {len(data)}', file=sys.stderr)
+
+    return 0, text['response']['key']
+
+def hash_chunks(filename, chunk_size):
+    import hashlib
+    hashes = []
+    with open(filename, 'rb') as fd:
+        while True:
+            data = fd.read(chunk_size)
+            if len(data) == 0:
+                break
+            hashes.append(hashlib.sha256(data).hexdigest())
+    return hashes
+
+def query_chunks(session, url, hashes, ttl=None):
+    # Asks the server which chunks it already stores.  Each one reported
+    # present is kept alive for at least ttl, and for the manifest of this
+    # send, by the server.
+    missing = []
+
+    headers = {}
+    if ttl is not None:
+        headers.update({
+            'X-ttl': ttl
+        })
+
+    for i in range(0, len(hashes), rclip_chunk_query_size):
+        data = {
+            'hashes': hashes[i:i + rclip_chunk_query_size]
+        }
+
+        try:
+            res = session.post(url, json=data, headers=headers)
+        except Exception as e:
+            exception_name = type(e).__name__
+            detail = str(e)
+            return errno.EIO, f'{exception_name} {detail}'
+
+        status = res.status_code
+        content_type = res.headers['Content-Type']
+        if content_type != 'application/json':
+            text = None
+        else:
+            text = json.loads(res.text)
+
+        if status >= 400:
+            if text is not None:
+                detail = text['detail']
+                return errno.ENOENT, f'{status} {detail}'
+            else:
+                return errno.ENOENT, f'{status} ({content_type})'
+
+        missing.extend(text['response']['missing'])
+
+    if verbose:
+        print(f'post url: {url}, chunks: {len(hashes)}, missing: {len(missing)}', file=sys.stderr)
+
+    return 0, missing
+
+def send_file(url, url_manifests, filename, ttl=None, chunk_size = None, jobs=None, url_chunks=None,
+              compression=True):
+    import concurrent.futures
     out_status = 0
     part_messages = []
 
@@ -225,67 +837,60 @@ def send_file(url, url_keys, filename, ttl=None, chunk_size = None):
     if chunk_size:
         chunk_size = int(chunk_size)
     else:
-        chunk_size = 1000000
+        chunk_size = rclip_default_chunk_size
+
+    if jobs:
+        jobs = int(jobs)
+    else:
+        jobs = rclip_default_jobs
 
     basename = os.path.basename(filename)
-    keys.append(urllib.parse.quote(basename))
 
+    # Fragments are read with pread by the worker that posts them, so at most
+    # `jobs` fragments are in memory; keys are kept in fragment order.  With
+    # url_chunks every fragment is keyed by its sha256 and only the chunks the
+    # server does not already hold are uploaded.
     try:
         file_size = os.path.getsize(filename)
-        with open(filename, 'rb') as fd:
-            read_size = 0
-            file_number = 0
-            while read_size < file_size:
-                fd.seek(read_size)
-                data = fd.read(chunk_size)
-                sz = len(data)
-                bd = io.BytesIO(data)
-
-                files = {
-                    'file': (f'{basename}.{file_number}', bd, 'application/octet-stream')
-                }
-
-                headers = {}
-                if ttl is not None:
-                    headers.update({
-                        'X-ttl': ttl
-                    })
-
-                res = None
-                try:
-                    res = requests.post(url, files=files, headers=headers)
-                except Exception as e:
-                    out_status = errno.EIO
-                    exception_name = type(e).__name__
-                    detail = str(e)
-                    part_messages.append(f'#{file_number} {exception_name} {detail}')
+        with open(filename, 'rb') as fd, new_session(jobs) as session, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            hashes = None
+            uploads = list(enumerate(range(0, file_size, chunk_size)))
+            if url_chunks is not None:
+                hashes = hash_chunks(filename, chunk_size)
+                first = {}
+                for file_number, h in enumerate(hashes):
+                    first.setdefault(h, file_number)
+                status, missing = query_chunks(session, url_chunks, list(first), ttl)
+                if status != 0:
+                    part_messages.append(f'* {missing}')
                     out_message = '\n'.join(part_messages)
-                    return out_status, out_message
-
-                if res is not None:
-                    status = res.status_code
-                    content_type = res.headers['Content-Type']
-                    if content_type != 'application/json':
-                        text = None
-                    else:
-                        text = json.loads(res.text)
-
-                if status >= 400:
-                    out_status = errno.ENOENT
-                    if text is not None:
-                        detail = text['detail']
-                        part_messages.append(f'#{file_number} {status} {detail}')
-                    else:
-                        part_messages.append(f'#{file_number} {status} ({content_type})')
-                else:
-                    key = text['response']['key']
-                    keys.append(key)
-
-                    if verbose:
-                        print(f'post url: {url}, file: {basename}.{file_number}, length: {sz}', file=sys.stderr)
+                    return status, out_message
+                uploads = [(first[h], first[h] * chunk_size) for h in missing]
+
+            futures = []
+            for file_number, offset in uploads:
+                futures.append(executor.submit(send_fragment, session, url, fd.fileno(), basename,
+                                               file_number, offset, chunk_size, ttl,
+                                               hashes[file_number] if hashes is not None else None,
+                                               compression))
+
+            for future in futures:
+                status, message = future.result()
+                if status == errno.EIO:
+                    for f in futures:
+                        f.cancel()
+                    part_messages.append(message)
+                    out_message = '\n'.join(part_messages)
+                    return status, out_message
+                elif status != 0:
+                    out_status = status
+                    part_messages.append(message)
+                elif hashes is None:
+                    keys.append(message)
 
-                read_size = read_size + sz
-                file_number = file_number + 1
+            if hashes is not None:
+                keys = hashes
 
     except Exception as e:
         out_status = errno.EIO
@@ -295,7 +900,7 @@ def send_file(url, url_keys, filename, ttl=None, chunk_size = None):
         out_message = '\n'.join(part_messages)
         return out_status, out_message
 
-    key_status, key_message = send(url_keys, ':'.join(keys), ttl, control_message=True)
+    key_status, key_message = send_manifest(url_manifests, basename, keys, ttl)
     if key_status == 0:
         out_message = key_message
     else:
@@ -304,7 +909,165 @@ def send_file(url, url_keys, filename, ttl=None, chunk_size = None):
         out_status = key_status
     return out_status, out_message
 
-def receive_file(url_base, filename, keys_string, force=False):
+def send_stream(url, url_manifests, stream, proc=None, errors=None, ttl=None, chunk_size=None, jobs=None, dedup=True,
+                compression=True):
+    # Cuts a stream into fragments as it is read and uploads each one while
+    # the next is read, with at most `jobs` uploads in flight, so memory stays
+    # within (jobs + 1) * chunk_size however long the stream is.  The file is
+    # registered under rclip_stream_name, which receivers write to stdout.
+    import concurrent.futures
+    import hashlib
+    out_status = 0
+    part_messages = []
+
+    if chunk_size:
+        chunk_size = int(chunk_size)
+    else:
+        chunk_size = rclip_default_chunk_size
+
+    if jobs:
+        jobs = int(jobs)
+    else:
+        jobs = rclip_default_jobs
+
+    keys = []
+    try:
+        with new_session(jobs) as session, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = []
+            file_number = 0
+            while True:
+                data = stream.read(chunk_size)
+                if len(data) == 0:
+                    break
+                chunk_hash = hashlib.sha256(data).hexdigest() if dedup is True else None
+                futures.append(executor.submit(send_fragment_data, session, url, data, rclip_stream_name,
+                                               file_number, ttl, chunk_hash, compression))
+                data = None
+                file_number += 1
+                while len(futures) >= jobs or (len(futures) > 0 and futures[0].done()):
+                    status, message = futures.pop(0).result()
+                    if status != 0:
+                        for f in futures:
+                            f.cancel()
+                        return status, message
+                    keys.append(message)
+            for future in futures:
+                status, message = future.result()
+                if status != 0:
+                    return status, message
+                keys.append(message)
+
+    except Exception as e:
+        out_status = errno.EIO
+        exception_name = type(e).__name__
+        detail = str(e)
+        part_messages.append(f'* {exception_name} {detail}')
+        out_message = '\n'.join(part_messages)
+        return out_status, out_message
+
+    if proc is not None:
+        proc.stdout.close()
+        if proc.wait() > 0:
+            return proc.returncode, read_errors(errors)
+
+    return send_manifest(url_manifests, rclip_stream_name, keys, ttl)
+
+def receive_stream(session, url, outs):
+    # Writes the whole file behind a manifest to each of outs in order.
+    res = None
+    try:
+        res = session.get(url, stream=True)
+        status = res.status_code
+        if status >= 400:
+            return errno.ENOENT, f'{status} {res.reason}'
+        for data in res.iter_content(chunk_size=rclip_download_chunk_size):
+            for out in outs:
+                out.write(data)
+        for out in outs:
+            out.flush()
+    except Exception as e:
+        exception_name = type(e).__name__
+        detail = str(e)
+        out_message = f'{exception_name} {detail}'
+        return errno.EIO, out_message
+    finally:
+        if res is not None:
+            res.close()
+
+    if verbose:
+        print(f'get url: {url}', file=sys.stderr)
+
+    return 0, None
+
+def receive_fragment(session, url, fileno, offset):
+    # Streams one fragment into fileno at offset with pwrite.  When the
+    # connection drops partway the fragment is requested again from the last
+    # received byte with Range and If-Range, so only the missing tail is
+    # downloaded.  A fragment sent compressed is decoded as it arrives; ranges
+    # then count compressed bytes while written counts decoded ones.
+    import requests
+    out_message = None
+    received = 0
+    written = 0
+    etag = None
+    decoder = None
+
+    for attempt in range(rclip_fragment_retries + 1):
+        headers = {
+            'X-Rclip-Accept-Encoding': ', '.join(available_encodings())
+        }
+        if received > 0:
+            headers.update({
+                'Range': f'bytes={received}-'
+            })
+            if etag is not None:
+                headers.update({
+                    'If-Range': etag
+                })
+
+        try:
+            with session.get(url, headers=headers, stream=True) as res:
+                status = res.status_code
+                if status >= 400:
+                    content_type = res.headers['Content-Type']
+                    if content_type != 'application/json':
+                        out_message = f'{status} ({content_type})'
+                    else:
+                        detail = json.loads(res.text)['detail']
+                        out_message = f'{status} {detail}'
+                    return errno.ENOENT, out_message, written
+
+                if status != 206:
+                    received = 0
+                    written = 0
+                    encoding = res.headers.get('X-Rclip-Encoding')
+                    decoder = decompressor(encoding) if encoding is not None else None
+                etag = res.headers.get('ETag')
+
+                for data in res.iter_content(chunk_size=rclip_download_chunk_size):
+                    received = received + len(data)
+                    if decoder is not None:
+                        data = decoder.decompress(data)
+                    os.pwrite(fileno, data, offset + written)
+                    written = written + len(data)
+
+            if verbose:
+                print(f'get url: {url}, length: {written}, received: {received}', file=sys.stderr)
+
+            return 0, None, written
+
+        except requests.exceptions.RequestException as e:
+            exception_name = type(e).__name__
+            detail = str(e)
+            out_message = f'{exception_name} {detail}'
+            if verbose:
+                print(f'get url: {url}, retry #{attempt + 1} from {received}: {out_message}', file=sys.stderr)
+
+    return errno.EIO, out_message, written
+
+def receive_file(url_base, filename, keys_string, force=False, jobs=None, url_manifest=None, outs=None):
+    import concurrent.futures
     out_status = 0
     out_message = None
     part_messages = []
@@ -313,48 +1076,86 @@ def receive_file(url_base, filename, keys_string, force=False):
     original_basename = urllib.parse.unquote(keys[0])
     keys = keys[1:]
 
+    # A streamed send goes back to stdout, or to outs, unless an output file
+    # is given.
+    if original_basename == rclip_stream_name and filename is None and url_manifest is not None:
+        sys.stdout.flush()
+        with new_session(1) as session:
+            out_status, out_message = receive_stream(session, url_manifest, outs or [sys.stdout.buffer])
+        return out_status, out_message
+
+    if jobs:
+        jobs = int(jobs)
+    else:
+        jobs = rclip_default_jobs
+
+    # With one job the server streams the whole file from its manifest in a
+    # single request.  Otherwise, since send_file cuts every fragment but the
+    # last to the same size, the first fragment gives the offset of all the
+    # others and the rest are fetched by `jobs` workers that pwrite straight
+    # into the output file.  A fragment list cut otherwise, found out by a
+    # fragment of another size, is streamed from its manifest after all.
     try:
         if filename is None:
             filename = original_basename
 
         mode = 'wb' if force is True else 'xb'
-        with open(filename, mode) as fd:
-
-            for key in keys:
-                sz = 0
-                res = None
-                try:
-                    url = url_base + '/' + key
-                    res = requests.get(url)
-                except Exception as e:
-                    out_status = errno.EIO
-                    exception_name = type(e).__name__
-                    detail = str(e)
-                    part_messages.append(f'{key} {exception_name} {detail}')
+        with open(filename, mode) as fd, new_session(jobs) as session, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            fileno = fd.fileno()
+            chunk_size = 0
+            if jobs == 1 and url_manifest is not None:
+                status, message, sz = receive_fragment(session, url_manifest, fileno, 0)
+                if status != 0:
+                    out_status = status
+                    part_messages.append(f'* {message}')
+                keys = []
+            elif len(keys) > 0:
+                status, message, chunk_size = receive_fragment(session, url_base + '/' + keys[0], fileno, 0)
+                if status != 0:
+                    part_messages.append(f'{keys[0]} {message}')
                     out_message = '\n'.join(part_messages)
-                    return out_status, out_message
-
-                if res is not None:
-                    status = res.status_code
-                    content_type = res.headers['Content-Type']
-                    if content_type != 'application/json':
-                        text = None
-                    else:
-                        text = json.loads(res.text)
-
-                    if status >= 400:
-                        out_status = errno.ENOENT
-                        if text is not None:
-                            detail = text['detail']
-                            part_messages.append(f'{key} {status} {detail}')
-                        else:
-                            part_messages.append(f'{key} {status} ({content_type})')
-                    else:
-                        fd.write(res.content)
-                        sz = len(res.content)
-
+                    return status, out_message
+                if len(keys) > 1:
+                    os.ftruncate(fileno, chunk_size * (len(keys) - 1))
+
+            futures = []
+            for i, key in enumerate(keys[1:], start=1):
+                futures.append(executor.submit(receive_fragment, session, url_base + '/' + key,
+                                               fileno, chunk_size * i))
+
+            uneven = None
+            for i, future in enumerate(futures, start=1):
+                status, message, sz = future.result()
+                if status == errno.EIO:
+                    for f in futures:
+                        f.cancel()
+                    part_messages.append(f'{keys[i]} {message}')
+                    out_message = '\n'.join(part_messages)
+                    return status, out_message
+                elif status != 0:
+                    out_status = status
+                    part_messages.append(f'{keys[i]} {message}')
+                elif sz != chunk_size and i < len(keys) - 1:
+                    uneven = f'{keys[i]} unexpected fragment length {sz} (expected {chunk_size})'
+                    break
+
+            if uneven is not None and url_manifest is None:
+                out_status = errno.EIO
+                part_messages.append(uneven)
+            elif uneven is not None:
+                for f in futures:
+                    f.cancel()
+                concurrent.futures.wait(futures)
                 if verbose:
-                    print(f'get url: {url}, length: {sz}', file=sys.stderr)
+                    print(f'{uneven}, receiving {url_manifest}', file=sys.stderr)
+                os.ftruncate(fileno, 0)
+                out_status = 0
+                part_messages = []
+                status, message, sz = receive_fragment(session, url_manifest, fileno, 0)
+                if status != 0:
+                    out_status = status
+                    part_messages.append(f'* {message}')
 
     except Exception as e:
         out_status = errno.EIO
@@ -374,7 +1175,7 @@ def ping(url, do_show_client_information):
 
     res = None
     try:
-        res = requests.get(url)
+        res = http_request('GET', url)
     except Exception as e:
         exception_name = type(e).__name__
         detail = str(e)
@@ -416,7 +1217,7 @@ def flush(url):
 
     res = None
     try:
-        res = requests.delete(url)
+        res = http_request('DELETE', url)
     except Exception as e:
         exception_name = type(e).__name__
         detail = str(e)
@@ -459,11 +1260,14 @@ def main():
             super(SortingHelpFormatter, self).add_arguments(actions)
 
     api = os.environ.get('RCLIP_API', 'http://localhost/')
+    global namespace
+    namespace = os.environ.get('RCLIP_NAMESPACE')
 
     parser = argparse.ArgumentParser(description='Remote clip', formatter_class=SortingHelpFormatter,
                                      epilog=f'''Current message api url: {api}
 You can modify this value with -a or $RCLIP_API.''')
     parser.add_argument('--api', nargs=1, help='message api url')
+    parser.add_argument('-n', '--namespace', nargs=1, help='clipboard namespace (default $RCLIP_NAMESPACE)')
     parser.add_argument('--input-from', nargs=1, metavar='COMMAND', help='pipe input from command')
     parser.add_argument('--input-encoding', nargs=1, metavar='CODING', help='encoding of pipe input')
     parser.add_argument('--output-to', nargs=1, metavar='COMMAND', help='pipe output to command')
@@ -472,27 +1276,63 @@ You can modify this value with -a or $RCLIP_API.''')
     parser.add_argument('--no-send-pipe', action='store_true', help='no pipe output when to send message')
     parser.add_argument('-v', '--verbose', action='store_true', help='verbose mode')
     parser.add_argument('-T', '--ttl', nargs=1, help='time to live')
+    parser.add_argument('-j', '--jobs', nargs=1, type=int, help=f'parallel fragment transfers (default {rclip_default_jobs})')
+    parser.add_argument('--no-compress', action='store_true', help='send messages and file fragments uncompressed')
+    parser.add_argument('--no-dedup', action='store_true', help='upload every file fragment even if the server holds it')
+    parser.add_argument('--no-raw', action='store_true',
+                        help='send and receive single messages as JSON, for servers without the raw message api')
     parser.add_argument('-F', '--force', action='store_true', help='force to overwrite existing file')
     parser.add_argument('-d', '--delete', action='store_true', help='delete message')
     parser.add_argument('-o', '--output', nargs=1, help='output file')
+    parser.add_argument('--batch', action='store_true', help='send each input line as a message of its own')
+    parser.add_argument('--stream', action='store_true',
+                        help='send stdin or --input-from output as fragments while it is being read')
+    parser.add_argument('--chunk-size', nargs=1, type=int, metavar='BYTES',
+                        help=f'fragment size of files and streams (default {rclip_default_chunk_size})')
+    parser.add_argument('--wait', action='store_true', help='wait for the message key to appear')
+    parser.add_argument('--watch', action='store_true',
+                        help='print the message key each time it changes until it is deleted')
+    parser.add_argument('--timeout', nargs=1, type=float, metavar='SECONDS', help='give up --wait or --watch after')
     subparser_group = parser.add_mutually_exclusive_group()
     subparser_group.add_argument('--ping', action='store_true', help='ping clipboard')
     subparser_group.add_argument('--flush', action='store_true', help='flush clipboard')
     subparser_group.add_argument('-f', '--file', nargs=1, help='message file')
     subparser_group.add_argument('-t', '--text', nargs=1, help='message text')
-    subparser_group.add_argument('key', nargs='?', help='message key')
+    subparser_group.add_argument('key', nargs='*', default=[], help='message keys, - to read them from stdin')
 
     args = parser.parse_args()
 
     if args.api:
         api = args.api[0]
+    if args.namespace:
+        namespace = args.namespace[0]
 
     global verbose
     verbose = args.verbose
 
     base_messages = 'api/v1/messages'
+    base_raw_messages = 'api/v1/raw/messages'
     base_files = 'api/v1/files'
+    base_manifests = 'api/v1/manifests'
+    base_chunks = 'api/v1/chunks'
     base_clipboard = 'api/v1/clipboard'
+    base_batch_messages = 'api/v1/batch/messages'
+
+    # Single messages go through the raw message api, their text as the body,
+    # unless --no-raw.
+    raw = not args.no_raw
+    base_single_messages = base_raw_messages if raw else base_messages
+
+    # Several keys, or '-' for keys read from stdin, are received or deleted
+    # in batches of up to rclip_batch_size per request.
+    keys = args.key
+    if keys == ['-']:
+        keys = sys.stdin.read().split()
+
+    # Without a key there is nothing to wait for, and the command would go on
+    # to send what it reads from stdin.
+    if (args.wait is True or args.watch is True) and len(keys) == 0:
+        parser.error('--wait and --watch need a key')
 
     method = None
     out_statuses = []
@@ -507,21 +1347,43 @@ You can modify this value with -a or $RCLIP_API.''')
         out_status, out_message = flush(url)
         out_statuses.append(out_status)
         out_messages.append(out_message)
+    elif args.delete is True and len(keys) > 1:
+        url = urljoin(api, base_batch_messages + '/delete')
+        out_status, out_message = delete_batch(url, keys)
+        if out_status != 0:
+            out_statuses.append(out_status)
+            out_messages.append(out_message)
+        else:
+            for s, m in out_message:
+                out_statuses.append(s)
+                out_messages.append(m)
     elif args.delete is True:
-        url = urljoin(api, base_messages + '/' + args.key)
+        url = urljoin(api, base_messages + '/' + (keys[0] if keys else ''))
         out_status, out_message = delete(url)
         out_statuses.append(out_status)
         out_messages.append(out_message)
-    elif args.key is None:
+    elif len(keys) == 0:
         method='send'
 
         f = args.file[0] if args.file else None
         t = args.text[0] if args.text else None
         ttl = args.ttl[0] if args.ttl else None
+        jobs = args.jobs[0] if args.jobs else None
+        chunk_size = args.chunk_size[0] if args.chunk_size else None
         if f:
             file_url = urljoin(api, base_files)
-            keys_url = urljoin(api, base_messages)
-            out_status, out_message = send_file(file_url, keys_url, f, ttl)
+            manifests_url = urljoin(api, base_manifests)
+            chunks_url = None if args.no_dedup else urljoin(api, base_chunks)
+            out_status, out_message = send_file(file_url, manifests_url, f, ttl, chunk_size=chunk_size, jobs=jobs,
+                                                url_chunks=chunks_url, compression=not args.no_compress)
+            out_statuses.append(out_status)
+            out_messages.append(out_message)
+        elif t is None and args.stream is True:
+            pipe = args.input_from[0] if args.input_from else None
+            stream, proc, errors = open_input(pipe)
+            out_status, out_message = send_stream(urljoin(api, base_files), urljoin(api, base_manifests), stream,
+                                                  proc, errors, ttl, chunk_size=chunk_size, jobs=jobs, dedup=not args.no_dedup,
+                                                  compression=not args.no_compress)
             out_statuses.append(out_status)
             out_messages.append(out_message)
         else:
@@ -532,22 +1394,84 @@ You can modify this value with -a or $RCLIP_API.''')
                 if t is None:
                     out_statuses.append(out_status)
                     out_messages.append(out_message)
-            if t is not None:
-                url = urljoin(api, base_messages)
-                out_status, out_message = send(url, t, ttl)
+            if t is not None and args.batch is True:
+                url = urljoin(api, base_batch_messages)
+                out_status, out_message = send_batch(url, t.splitlines(keepends=True), ttl,
+                                                     compression=not args.no_compress)
+                if out_status == 0:
+                    out_message = ''.join(key + '\n' for key in out_message)
+                out_statuses.append(out_status)
+                out_messages.append(out_message)
+            elif t is not None:
+                url = urljoin(api, base_single_messages)
+                out_status, out_message = send(url, t, ttl, compression=not args.no_compress, raw=raw)
                 out_statuses.append(out_status)
                 out_messages.append(out_message)
     else:
         method='receive'
 
-        o = args.output[0] if args.output else None
-        keys_url = urljoin(api, base_messages + '/' + args.key)
-        out_status, out_message = receive(keys_url)
-        if out_status == rclip_status_file_fragment_list:
-            base_url = urljoin(api, base_files)
-            out_status, out_message = receive_file(base_url, o, out_message, force=args.force)
-        out_statuses.append(out_status)
-        out_messages.append(out_message)
+        o = args.output[0] if args.output and len(keys) == 1 else None
+        timeout = args.timeout[0] if args.timeout else None
+
+        def receive_result(key, out_status, out_message):
+            # Downloads the file a fragment list stands for.
+            if out_status == rclip_status_file_fragment_list:
+                base_url = urljoin(api, base_files)
+                jobs = args.jobs[0] if args.jobs else None
+                manifest_url = urljoin(api, base_manifests + '/' + key)
+                # A streamed send is piped to --output-to as it downloads.
+                proc = None
+                outs = None
+                name = urllib.parse.unquote(out_message.split(':')[0])
+                if name == rclip_stream_name and o is None and args.output_to:
+                    proc, errors = open_output(args.output_to[0])
+                    outs = [proc.stdin] if args.no_receive_stdout else [sys.stdout.buffer, proc.stdin]
+                out_status, out_message = receive_file(base_url, o, out_message, force=args.force, jobs=jobs,
+                                                       url_manifest=manifest_url, outs=outs)
+                if proc is not None:
+                    close_output(proc, errors)
+            return out_status, out_message
+
+        if (args.wait is True or args.watch is True) and re.fullmatch(rclip_key_pattern, keys[0]) is None:
+            # The server answers a key it cannot have made at once, so the
+            # wait would never end.
+            out_statuses.append(errno.EINVAL)
+            out_messages.append(f'Invalid key {keys[0]}')
+        elif args.watch is True:
+            # Every version is written out as it arrives; the watch ends
+            # quietly when the message is deleted or expires, or at --timeout.
+            keys_url = urljoin(api, base_single_messages + '/' + keys[0])
+            etag = None
+            deadline = time.monotonic() + timeout if timeout is not None else None
+            while True:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                out_status, out_message, etag = wait_message(keys_url, etag, remaining, raw=raw)
+                if out_status == errno.ETIMEDOUT or (out_status == errno.ENOENT and etag is not None):
+                    break
+                out_status, out_message = receive_result(keys[0], out_status, out_message)
+                if out_status != 0:
+                    out_statuses.append(out_status)
+                    out_messages.append(out_message)
+                    break
+                write_output(args, method, out_message)
+                sys.stdout.flush()
+        else:
+            if len(keys) > 1:
+                url = urljoin(api, base_batch_messages + '/get')
+                out_status, results = receive_batch(url, keys)
+                if out_status != 0:
+                    results = [(out_status, results)]
+            elif args.wait is True:
+                keys_url = urljoin(api, base_single_messages + '/' + keys[0])
+                out_status, out_message, _ = wait_message(keys_url, timeout=timeout, raw=raw)
+                results = [(out_status, out_message)]
+            else:
+                keys_url = urljoin(api, base_single_messages + '/' + keys[0])
+                results = [receive(keys_url, raw=raw)]
+            for key, (out_status, out_message) in zip(keys, results):
+                out_status, out_message = receive_result(key, out_status, out_message)
+                out_statuses.append(out_status)
+                out_messages.append(out_message)
 
     exit_status = 0
     for s, m in zip(out_statuses, out_messages):
@@ -556,11 +1480,14 @@ You can modify this value with -a or $RCLIP_API.''')
             if exit_status == 0:
                 exit_status = s
         else:
-            pipe = args.output_to[0] if args.output_to else None
-            pipe_encoding = args.output_encoding[0] if args.output_encoding else None
-            write_to_stdout(m, method, pipe, pipe_encoding, no_r_stdout=args.no_receive_stdout, no_s_pipe=args.no_send_pipe)
+            write_output(args, method, m)
 
     return exit_status
 
+def write_output(args, method, message):
+    pipe = args.output_to[0] if args.output_to else None
+    pipe_encoding = args.output_encoding[0] if args.output_encoding else None
+    write_to_stdout(message, method, pipe, pipe_encoding, no_r_stdout=args.no_receive_stdout, no_s_pipe=args.no_send_pipe)
+
 if __name__ == '__main__':
     exit(main())
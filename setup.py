@@ -14,6 +14,9 @@ setup(
     url='http://github.com/mkyutani/rclip',
     packages=find_packages(),
     install_requires=open('requirements.txt').read().splitlines(),
+    extras_require={
+        'zstd': ['zstandard'],
+    },
     entry_points={
         'console_scripts': [
             'rclip=rclip.rclip:main',